@@ -1,26 +1,32 @@
-import sys
+#!/usr/bin/env python3
+import argparse
+from src.metrics import score_files
 
-src_file = sys.argv[1]
-orig_file = sys.argv[2]
-pred_file = sys.argv[3]
 
-with open(src_file) as s, open(orig_file) as o, open(pred_file) as p:
-    slines = s.readlines()
-    olines = o.readlines()
-    plines = p.readlines()
-   
-    total = 0
-    matched = 0
-   
-    for sline, oline, pline in zip(slines, olines, plines):
-        oline, pline = oline.strip(), pline.strip()
-        
-        if oline != pline:
-            print(f"MISMATCH : SOURCE: {sline} \t || \t ORIGINAL : {oline} \t || \t PRED : {pline}")
-        else:
-            matched += 1
-        
-        total += 1
-        
-    print(f"TOTAL: {total}, MATCHED : {matched}, ACCURACY: {(matched * 100) / total}")
-    
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(
+        description="Exact-match and token accuracy of predictions against the original targets"
+    )
+    parser.add_argument("src_file", help="Source sentences")
+    parser.add_argument("orig_file", help="Original (reference) targets")
+    parser.add_argument("pred_file", help="Predicted targets")
+    parser.add_argument("--mismatches", default=None,
+                        help="Write mismatched examples to this file as JSON lines")
+    parser.add_argument("--max-mismatches", type=int, default=1000,
+                        help="Most mismatches written to --mismatches")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Scoring processes (default: one per core)")
+    args = parser.parse_args()
+
+    try:
+        metrics = score_files(args.orig_file, args.pred_file, args.src_file, args.workers,
+                              mismatches=args.mismatches, max_mismatches=args.max_mismatches)
+    except ValueError as e:
+        parser.error(str(e))
+    print(metrics.report())
+    total, matched = metrics.examples, metrics.exact
+    print(f"TOTAL: {total}, MATCHED : {matched}, ACCURACY: {(matched * 100) / max(total, 1)}")
+
+
+if __name__ == "__main__":
+    main()
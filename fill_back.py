@@ -1,10 +1,12 @@
-import sys
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import functools
+import itertools
 import json
-
-read_from = sys.argv[1]
-wmap_file = sys.argv[2]
-check_with = sys.argv[3]
-
+import os
+import sys
+from multiprocessing import Pool
 
 rmap = {
     "I_JUMP" : "jump",
@@ -15,56 +17,155 @@ rmap = {
     "I_TURN_LEFT" : "left"
 }
 rmap_r = {y : x for x, y in rmap.items()}
+# fills the missing rows of a file that ends early; wmaps may be null
+MISSING = object()
+
+
+def iter_wmaps(f, bufsize=1 << 16):
+    """
+    Yield the wmaps of a file one at a time without loading it whole.
+    Accepts a JSON array (the wmaps_*.json files) or one JSON value per line
+    (generate_source.py --keys word). The array is decoded incrementally
+    from a buffer that only holds the elements not yet returned.
+    """
+    decoder = json.JSONDecoder()
+    buf = f.read(bufsize).lstrip()
+    while buf == "":
+        more = f.read(bufsize)
+        if not more:
+            return
+        buf = more.lstrip()
+    pos = 0
+    eof = False
+    is_array = buf[pos:pos + 1] == "["
+    if is_array:
+        pos += 1
+    while True:
+        # skip separators between elements
+        while pos < len(buf) and (buf[pos].isspace() or (is_array and buf[pos] == ",")):
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                if is_array:
+                    raise ValueError("wmap array is not terminated")
+                return
+            buf, pos = f.read(bufsize), 0
+            eof = not buf
+            continue
+        if is_array and buf[pos] == "]":
+            return
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            end = None
+        # a value reaching the end of the buffer may continue in the next read
+        if end is None or (end == len(buf) and not eof):
+            more = f.read(bufsize)
+            if not more:
+                if end is None:
+                    raise ValueError(f"malformed wmap file near: {buf[pos:pos + 80]!r}")
+                eof = True
+                continue
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield value
+        pos = end
+
+
+def slot_actions(wmap):
+    """Map each slot of a {word: slot} wmap to its action token, or None.
+    A slot filled by several words takes the last one. A null wmap (a line
+    generate_source.py could not align) has no slots, so lines pass through."""
+    if wmap is None:
+        return {}
+    return {slot: rmap_r.get(word) for word, slot in wmap.items()}
+
+
+def restore(line, actions):
+    """Replace the slots of a construction-format line by their actions.
+    Slots whose word is not an action are dropped; unknown slots are kept."""
+    out = []
+    for w in line.split():
+        if w.startswith("C_") and w in actions:
+            if actions[w] is not None:
+                out.append(actions[w])
+        else:
+            out.append(w)
+    return " ".join(out)
+
+
+def fill_chunk(chunk, with_refs=False):
+    """Restore a list of (prediction, reference, wmap) triples; return the
+    restored predictions (and references) and the number of exact matches."""
+    preds, refs = [], []
+    correct = 0
+    for pred, ref, wmap in chunk:
+        actions = slot_actions(wmap)
+        pred, ref = restore(pred, actions), restore(ref, actions)
+        correct += pred == ref
+        preds.append(pred)
+        if with_refs:
+            refs.append(ref)
+    return preds, refs, correct
+
+
+def read_chunks(pred_file, ref_file, wmaps, size):
+    """Yield lists of up to `size` (prediction, reference, wmap) triples,
+    reading the three inputs in lockstep."""
+    triples = itertools.zip_longest(pred_file, ref_file, wmaps, fillvalue=MISSING)
+    while True:
+        chunk = list(itertools.islice(triples, size))
+        if not chunk:
+            return
+        if any(x is MISSING for x in chunk[-1]):
+            raise ValueError("predictions, references and wmaps have different lengths")
+        yield [(p.strip(), r.strip(), m) for p, r, m in chunk]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Restore the actions of construction-format predictions and references "
+                    "from their wmaps and report exact-match accuracy."
+    )
+    parser.add_argument("read_from", help="Predictions in construction format")
+    parser.add_argument("wmap_file", help="wmaps_*.json array, or one wmap per line")
+    parser.add_argument("check_with", help="References in construction format")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Restored predictions (default: READ_FROM.restored)")
+    parser.add_argument("--ref-output", default=None,
+                        help="Also write the restored references here")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Worker processes restoring chunks (default: one per core)")
+    parser.add_argument("--chunk-size", type=int, default=2000,
+                        help="Lines sent to a worker at a time")
+    args = parser.parse_args()
+
+    output = args.output or args.read_from + ".restored"
+    total = correct = 0
+    with open(args.read_from) as pf, open(args.check_with) as rf, \
+            open(args.wmap_file) as mf, open(output, "w") as out, \
+            (open(args.ref_output, "w") if args.ref_output
+             else contextlib.nullcontext()) as ref_out:
+        chunks = read_chunks(pf, rf, iter_wmaps(mf), args.chunk_size)
+        worker = functools.partial(fill_chunk, with_refs=ref_out is not None)
+        pool = Pool(args.workers) if args.workers > 1 else None
+        try:
+            for preds, refs, matched in (pool.imap(worker, chunks) if pool
+                                         else map(worker, chunks)):
+                out.write("\n".join(preds) + "\n")
+                if ref_out is not None:
+                    ref_out.write("\n".join(refs) + "\n")
+                total += len(preds)
+                correct += matched
+        except ValueError as e:
+            sys.exit(f"error: {e}")
+        finally:
+            if pool:
+                pool.terminate()
+
+    print(correct, total, correct * 100 / max(total, 1))
+
 
-wmaps = json.loads(open(wmap_file).read())
-
-total = 0
-correct = 0
-with open(read_from) as f, open(check_with) as cw:
-    
-    cwlines = cw.readlines()
-    for li, line in enumerate(f):
-        total+=1
-        line = line.strip().split()
-        #print(line)
-        
-        wmap = wmaps[li]
-        rwmap = {y : x for x, y in wmap.items()}
-        #print(rwmap)
-        new_line = []
-        for w in line:
-            if w.startswith("C_") and (w in rwmap):
-                t = rwmap[w]
-                if t in rmap_r:
-                    new_line.append(rmap_r[t])
-            else:
-                new_line.append(w)
-                
-        #print(new_line)
-        
-        #break
-        
-        new_line = " ".join(new_line)
-        
-        print(new_line)
-        cwline = cwlines[li].strip()
-        
-        new_cline = []
-        for w in cwline.split():
-            if w.startswith("C_") and (w in rwmap):
-                t = rwmap[w]
-                if t in rmap_r:
-                    new_cline.append(rmap_r[t])
-            else:
-                new_cline.append(w)
-        cline = " ".join(new_cline)
-            
-        print(cline)
-        
-        if new_line == cline:
-            correct +=1 
-        
-        print()
-        # wf.write(new_line+"\n")
-
-print(correct, total, correct * 100/ total)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
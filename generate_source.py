@@ -1,61 +1,148 @@
-import sys
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import functools
+import itertools
+import json
+import os
 import re
+import sys
+import time
+from multiprocessing import Pool
+
+GROUP = re.compile(r"\(\s*(.*?)\s*\)")
+NAMED_SLOT = re.compile(r"[A-Z]_\w+$")
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def compile_template(line):
+    """
+    Compile a template line such as '( _ day ) ( , ) ( a _ )' for matching.
+    Returns the number of tokens, the (position, token) pairs that must
+    match literally and the (position, slot) pairs. Each '_' is a new slot
+    named W_1, W_2, ... in order; tokens like 'C_5' or 'W_2' name their slot.
+    A line without brackets is one template of literal tokens.
+    """
+    groups = GROUP.findall(line) if "(" in line else [line]
+    tokens = " ".join(groups).split()
+    literals, slots = [], []
+    anonymous = 0
+    for pos, tok in enumerate(tokens):
+        if tok == "_":
+            anonymous += 1
+            slots.append((pos, f"W_{anonymous}"))
+        elif NAMED_SLOT.match(tok):
+            slots.append((pos, tok))
+        else:
+            literals.append((pos, tok))
+    return len(tokens), tuple(literals), tuple(slots)
+
+
+def align(template, sentence, keys="slot"):
+    """
+    Return the slot fills of a plain sentence under its template line, as
+    {slot: word} or, with keys="word", {word: slot} like the wmaps_*.json
+    files. Returns None when the sentence does not have the template's
+    length or a literal token of the template differs from the word at its
+    position.
+    """
+    length, literals, slots = compile_template(template)
+    words = sentence.split()
+    if len(words) != length:
+        return None
+    for pos, tok in literals:
+        if words[pos] != tok:
+            return None
+    if keys == "word":
+        return {words[pos]: slot for pos, slot in slots}
+    return {slot: words[pos] for pos, slot in slots}
+
+
+def format_map(wmap, fmt):
+    if fmt == "json":
+        # one element of a json.dump(maps, indent=4) list
+        return "    " + json.dumps(wmap, indent=4).replace("\n", "\n    ")
+    return json.dumps(wmap)
+
+
+def align_chunk(chunk, fmt="jsonl", keys="slot"):
+    """Align a list of (template, sentence) pairs; return the formatted maps
+    and the number of lines that did not align."""
+    out = []
+    unaligned = 0
+    for template, sentence in chunk:
+        wmap = align(template, sentence, keys)
+        if wmap is None:
+            unaligned += 1
+        out.append(format_map(wmap, fmt))
+    return out, unaligned
+
+
+def read_chunks(template_file, plain_file, size):
+    """Yield lists of up to `size` (template, sentence) pairs, streaming both files."""
+    pairs = itertools.zip_longest(template_file, plain_file)
+    while True:
+        chunk = list(itertools.islice(pairs, size))
+        if not chunk:
+            return
+        if chunk[-1][0] is None or chunk[-1][1] is None:
+            raise ValueError("template and plain files have different numbers of lines")
+        yield [(t.strip(), s.strip()) for t, s in chunk]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Align plain sentences with their construction templates and write "
+                    "the slot fills of every line."
+    )
+    parser.add_argument("templates", help="Template lines, e.g. data/ts/cxn/train.src")
+    parser.add_argument("plain", nargs="?", default=None,
+                        help="Plain sentences, one per template line (default: TEMPLATES.plain)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="Output file (default: stdout)")
+    parser.add_argument("--format", choices=["jsonl", "json"], default="jsonl",
+                        help="jsonl: one map per line, null for lines that do not align; "
+                             "json: a list in the layout of the wmaps_*.json files")
+    parser.add_argument("--keys", choices=["slot", "word"], default="slot",
+                        help="slot: {slot: word} fills; word: {word: slot} maps as in wmaps_*.json")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Aligner processes (default: one per core)")
+    parser.add_argument("--chunk-size", type=int, default=2000,
+                        help="Lines sent to a worker at a time")
+    args = parser.parse_args()
+
+    plain = args.plain or args.templates + ".plain"
+    total = unaligned = 0
+    start = time.perf_counter()
+    with open(args.templates) as tf, open(plain) as pf, \
+            (open(args.output, "w") if args.output != "-"
+             else contextlib.nullcontext(sys.stdout)) as out:
+        chunks = read_chunks(tf, pf, args.chunk_size)
+        worker = functools.partial(align_chunk, fmt=args.format, keys=args.keys)
+        pool = Pool(args.workers) if args.workers > 1 else None
+        try:
+            results = pool.imap(worker, chunks) if pool else map(worker, chunks)
+            sep = "[\n" if args.format == "json" else ""
+            for lines, bad in results:
+                if args.format == "json":
+                    for line in lines:
+                        out.write(sep + line)
+                        sep = ",\n"
+                else:
+                    out.write("\n".join(lines) + "\n")
+                total += len(lines)
+                unaligned += bad
+            if args.format == "json":
+                out.write("\n]" if total else "[]")
+        except ValueError as e:
+            sys.exit(f"error: {e}")
+        finally:
+            if pool:
+                pool.terminate()
+    elapsed = time.perf_counter() - start
+    print(f"{total} lines, {total - unaligned} aligned, {unaligned} unaligned, "
+          f"{total / max(elapsed, 1e-9):.0f} lines/s", file=sys.stderr)
+
 
-inp_file = sys.argv[1]
-src_file = sys.argv[2]
-gen_file = sys.argv[3]
-mode = sys.argv[4]
-
-tups = re.compile("\((.*?)\)+")
-
-with open(inp_file) as ip, open(src_file) as s, open(gen_file) as g:
-    slines = s.readlines()
-    glines = g.readlines()
-    ilines = ip.readlines()
-    for sid, sline in enumerate(slines):
-        sline = sline.strip().split(" ")
-        iline = ilines[sid].strip()
-        
-        ### W to W substitution
-        iline = iline.strip()
-        iline = iline.replace("( ", "").replace(") ", "").strip("() ")
-        print(iline)
-        break
-        
-        gline = glines[sid].strip()
-        #print(sline)
-        #print(gline)
-        #print(tups.findall(gline))
-        templates = [x.strip().split() for x in tups.findall(gline)]
-        #print(templates)
-        
-        current_tpl = templates[0]
-        ctpl_idx = 0
-        tidx = 0
-        mask_map = {}
-        for widx in range(len(sline)):
-            w = sline[widx]
-            if tidx > len(current_tpl) - 1:
-                tidx = 0
-                current_tpl = templates[ctpl_idx + 1]
-                ctpl_idx += 1
-            
-            tw = current_tpl[tidx]
-            if tw.startswith("W_"):
-                if tw not in mask_map:
-                    mask_map[tw] = None
-                mask_map[tw] = w
-                
-            tidx += 1
-                
-        for k, v in mask_map.items():
-            if mode == "all":
-                print(f"IN: {ipline} || OUT: {gline} || W: {k} || V: {v}")
-            elif mode == "input":
-                print(f"IN: {ipline} || OUT: {gline} || W: {k}")
-            elif mode == "output":
-                print(f"V: {v}")
-        
-        
-        
-        
\ No newline at end of file
+if __name__ == "__main__":
+    main()
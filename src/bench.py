@@ -0,0 +1,302 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import numpy as np
+import torch
+
+SCAN = ('data/scan/simple/train.src', 'data/scan/simple/train.tgt',
+        'data/scan/simple/test.src', 'data/scan/simple/test.tgt')
+TS = ('data/ts/plain/train.src', 'data/ts/plain/train.tgt',
+      'data/ts/plain/test.src', 'data/ts/plain/test.tgt')
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def _percentiles(times):
+    times = sorted(times)
+    return {'p50_ms': 1000 * times[len(times) // 2],
+            'p99_ms': 1000 * times[min(len(times) - 1, int(0.99 * len(times)))]}
+
+
+def bench_text_dataset(cfg):
+    """Preprocess and reopen the LM corpus with ``TextDataset``."""
+    from .data import TextDataset
+    rss = _peak_rss_mb()
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = shutil.copy(TS[1], os.path.join(tmp, 'corpus.txt'))
+        start = time.perf_counter()
+        dataset = TextDataset(corpus, cfg['seq_len'])
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        TextDataset(corpus, cfg['seq_len'])
+        reload = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(0, len(dataset), max(1, len(dataset) // 10000)):
+            dataset[i]
+        fetch = (time.perf_counter() - start) / min(len(dataset), 10000)
+    return {'build_s': build, 'reload_s': reload, 'getitem_us': 1e6 * fetch,
+            'peak_rss_mb': _peak_rss_mb(), 'rss_growth_mb': _peak_rss_mb() - rss}
+
+
+def bench_parallel_dataset(cfg):
+    """Build ``ParallelTextDataset`` on SCAN and time batch fetch plus collate."""
+    from .seq2seq.data import ParallelTextDataset, collate_fn
+    rss = _peak_rss_mb()
+    start = time.perf_counter()
+    dataset = ParallelTextDataset(SCAN[0], SCAN[1])
+    build = time.perf_counter() - start
+    rng = np.random.default_rng(cfg['seed'])
+    batches = [rng.choice(len(dataset), cfg['batch_size']).tolist() for _ in range(200)]
+    start = time.perf_counter()
+    for batch in batches:
+        collate_fn(dataset.__getitems__(batch))
+    collate = (time.perf_counter() - start) / len(batches)
+    return {'build_s': build, 'collate_us': 1e6 * collate,
+            'peak_rss_mb': _peak_rss_mb(), 'rss_growth_mb': _peak_rss_mb() - rss}
+
+
+def _train_steps(step, batches, warmup):
+    for batch in batches[:warmup]:
+        step(*batch)
+    tokens = 0
+    start = time.perf_counter()
+    for batch in batches[warmup:]:
+        tokens += step(*batch)
+    elapsed = time.perf_counter() - start
+    return {'train_tps': tokens / elapsed,
+            'step_ms': 1000 * elapsed / len(batches[warmup:]),
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def bench_train_lm(cfg, cutoffs=None):
+    """Training steps of ``TransformerLM`` on the TS corpus."""
+    from .data import TextDataset
+    from .model import TransformerLM
+    with tempfile.TemporaryDirectory() as tmp:
+        dataset = TextDataset(shutil.copy(TS[1], os.path.join(tmp, 'corpus.txt')), cfg['seq_len'])
+        model = TransformerLM(len(dataset.vocab), cfg['d_model'], cfg['nhead'],
+                              cfg['num_layers'], cfg['dim_ff'], 0.1, cutoffs)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        criterion = torch.nn.CrossEntropyLoss(ignore_index=0)
+        generator = torch.Generator().manual_seed(cfg['seed'])
+        order = torch.randperm(len(dataset), generator=generator).tolist()
+        batches = []
+        for b in range(cfg['warmup'] + cfg['steps']):
+            idx = order[b * cfg['batch_size']:(b + 1) * cfg['batch_size']]
+            src = torch.stack([dataset[i][0] for i in idx]).long()
+            tgt = torch.stack([dataset[i][1] for i in idx]).long()
+            batches.append((src, tgt))
+
+        def step(src, tgt):
+            optimizer.zero_grad()
+            if cutoffs:
+                model(src, is_causal=True, targets=tgt).backward()
+            else:
+                out = model(src, is_causal=True)
+                criterion(out.reshape(-1, out.size(-1)), tgt.reshape(-1)).backward()
+            optimizer.step()
+            return src.numel()
+
+        model.train()
+        return _train_steps(step, batches, cfg['warmup'])
+
+
+def bench_train_lm_adaptive(cfg):
+    """``train_lm`` with an adaptive softmax head (cutoffs 500 and 2000)."""
+    return bench_train_lm(cfg, cutoffs=[500, 2000])
+
+
+def bench_train_seq2seq(cfg, packed=True):
+    """Training steps of ``Seq2SeqTransformer`` on SCAN."""
+    from .seq2seq.data import ParallelTextDataset, collate_fn
+    from .seq2seq.model import Seq2SeqTransformer
+    dataset = ParallelTextDataset(SCAN[0], SCAN[1])
+    model = Seq2SeqTransformer(len(dataset.src_vocab), len(dataset.tgt_vocab), cfg['d_model'],
+                               cfg['nhead'], cfg['num_layers'], cfg['dim_ff'], 0.1)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    criterion = torch.nn.CrossEntropyLoss(ignore_index=0)
+    rng = np.random.default_rng(cfg['seed'])
+    batches = [collate_fn(dataset.__getitems__(rng.choice(len(dataset), cfg['batch_size']).tolist()))
+               for _ in range(cfg['warmup'] + cfg['steps'])]
+
+    def step(src, tgt):
+        tgt_inp, tgt_out = tgt[:, :-1], tgt[:, 1:]
+        optimizer.zero_grad()
+        out = model(src, tgt_inp, src_padding_mask=src == 0, tgt_padding_mask=tgt_inp == 0,
+                    tgt_is_causal=True, packed=packed)
+        if packed:
+            criterion(out, tgt_out[tgt_inp != 0]).backward()
+        else:
+            criterion(out.reshape(-1, out.size(-1)), tgt_out.reshape(-1)).backward()
+        optimizer.step()
+        return int((src != 0).sum()) + int((tgt != 0).sum())
+
+    model.train()
+    return _train_steps(step, batches, cfg['warmup'])
+
+
+def bench_train_seq2seq_padded(cfg):
+    """``train_seq2seq`` with the decoder run over the padded targets."""
+    return bench_train_seq2seq(cfg, packed=False)
+
+
+def _bench_decode(paths, cfg):
+    from .seq2seq.data import ParallelTextDataset
+    from .seq2seq.evaluate import greedy_decode, load_tokenized_dataset
+    from .seq2seq.model import Seq2SeqTransformer
+    train = ParallelTextDataset(paths[0], paths[1])
+    test = load_tokenized_dataset(paths[2], paths[3], train.src_vocab, train.tgt_vocab)
+    # the untrained model is seeded, so it makes the same predictions and
+    # decodes the same number of steps on every run
+    model = Seq2SeqTransformer(len(train.src_vocab), len(train.tgt_vocab), cfg['d_model'],
+                               cfg['nhead'], cfg['num_layers'], cfg['dim_ff'], 0.1).eval()
+    examples = test.data[:cfg['decode_sentences']]
+    times, tokens = [], 0
+    with torch.no_grad():
+        for src_ids, tgt_ids in examples:
+            start = time.perf_counter()
+            pred = greedy_decode(model, src_ids, test.src_vocab, test.tgt_vocab, 'cpu',
+                                 max_len=len(tgt_ids) + 2)
+            times.append(time.perf_counter() - start)
+            tokens += len(pred)
+    return dict(_percentiles(times), token_ms=1000 * sum(times) / max(tokens, 1),
+                peak_rss_mb=_peak_rss_mb())
+
+
+def bench_decode_scan(cfg):
+    """Greedy decoding latency per sentence on the SCAN test split."""
+    return _bench_decode(SCAN, cfg)
+
+
+def bench_decode_ts(cfg):
+    """Greedy decoding latency per sentence on the TS test split."""
+    return _bench_decode(TS, cfg)
+
+
+BENCHMARKS = {
+    'text_dataset': bench_text_dataset,
+    'parallel_dataset': bench_parallel_dataset,
+    'train_lm': bench_train_lm,
+    'train_lm_adaptive': bench_train_lm_adaptive,
+    'train_seq2seq': bench_train_seq2seq,
+    'train_seq2seq_padded': bench_train_seq2seq_padded,
+    'decode_scan': bench_decode_scan,
+    'decode_ts': bench_decode_ts,
+}
+
+
+def _run_isolated(name, cfg):
+    torch.manual_seed(cfg['seed'])
+    torch.set_num_threads(cfg['threads'])
+    return BENCHMARKS[name](cfg)
+
+
+def metadata(cfg):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'git_commit': commit,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'config': cfg,
+    }
+
+
+def higher_is_better(metric):
+    return metric.endswith('_tps')
+
+
+def run(names, cfg, repeat=3):
+    """Run each benchmark ``repeat`` times and keep the best value of every metric."""
+    results = {}
+    context = mp.get_context('spawn')
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                runs.append(pool.submit(_run_isolated, name, cfg).result())
+        results[name] = {metric: (max if higher_is_better(metric) else min)(r[metric] for r in runs)
+                         for metric in runs[0]}
+        print(name, ' '.join(f'{k}={v:.4g}' for k, v in results[name].items()))
+    return {'meta': dict(metadata(cfg), repeat=repeat), 'results': results}
+
+
+def compare(current, baseline, tolerance=0.1):
+    """Print every shared metric against ``baseline``; return the regressions."""
+    regressions = []
+    print(f"{'benchmark':18}{'metric':15}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, metrics in current['results'].items():
+        for metric, value in metrics.items():
+            old = baseline['results'].get(name, {}).get(metric)
+            if old is None:
+                continue
+            change = value / old - 1 if old else 0.0
+            worse = -change if higher_is_better(metric) else change
+            flag = ''
+            if worse > tolerance:
+                regressions.append((name, metric))
+                flag = '  REGRESSION'
+            print(f"{name:18}{metric:15}{old:12.4g}{value:12.4g}{change:10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the CPU benchmark suite')
+    parser.add_argument('--output', type=str, default='bench.json',
+                        help='Where to write the results as JSON')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=None,
+                        help='Run only these benchmarks')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Earlier results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative slowdown reported as a regression')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per benchmark; the best value of each metric is kept')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--steps', type=int, default=30,
+                        help='Timed training steps')
+    parser.add_argument('--decode-sentences', type=int, default=200)
+    args = parser.parse_args()
+    cfg = {
+        'threads': args.threads, 'seed': args.seed, 'steps': args.steps, 'warmup': 5,
+        'batch_size': 32, 'seq_len': 16, 'decode_sentences': args.decode_sentences,
+        'd_model': 128, 'nhead': 4, 'num_layers': 2, 'dim_ff': 512,
+    }
+    report = run(args.only or list(BENCHMARKS), cfg, args.repeat)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to', args.output)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('config') != cfg:
+            print('Warning: the baseline was run with a different configuration')
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
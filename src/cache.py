@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Return the sha256 hex digest of a file's content."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class TokenCache:
+    """On-disk cache for tokenized datasets.
+
+    Entries are keyed by the content hash of the input files together with
+    the parameters that affect tokenization (``min_freq``, a given
+    vocabulary, ...), so editing a file or changing a parameter simply misses
+    the cache. Every file of an entry is named ``<key>.<suffix>`` inside
+    ``cache_dir``. When the directory grows beyond ``max_bytes`` the least
+    recently used entries are deleted.
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, paths, **params):
+        h = hashlib.sha256()
+        for path in paths:
+            h.update(file_digest(path).encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def path(self, key, suffix=''):
+        """Location of an entry's file; callers may write their own formats here."""
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def touch(self, key):
+        for name in self._entry_files(key):
+            os.utime(os.path.join(self.cache_dir, name))
+
+    def load(self, key):
+        """Return ``(arrays, meta)`` stored under ``key`` or ``None``."""
+        path = self.path(key, '.npz')
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                arrays = {name: f[name] for name in f.files if name != '__meta__'}
+                meta = json.loads(str(f['__meta__']))
+        except (OSError, ValueError, KeyError):
+            return None
+        self.touch(key)
+        return arrays, meta
+
+    def store(self, key, arrays, meta):
+        """Save numpy ``arrays`` and JSON-serialisable ``meta`` under ``key``."""
+        # a unique temporary file per writer: processes sharing the cache may
+        # store the same entry at once, and the last complete file wins
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=key + '.', suffix='.tmp.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, __meta__=np.array(json.dumps(meta)), **arrays)
+            os.replace(tmp, self.path(key, '.npz'))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until the cache fits ``max_bytes``.
+
+        The entry ``keep`` (usually the one just written) is never deleted.
+        """
+        if self.max_bytes is None:
+            return
+        entries = {}
+        for name in os.listdir(self.cache_dir):
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:  # moved or deleted by another process
+                continue
+            size, last_used = entries.get(name.split('.', 1)[0], (0, 0))
+            entries[name.split('.', 1)[0]] = (size + stat.st_size, max(last_used, stat.st_mtime))
+        total = sum(size for size, _ in entries.values())
+        for key, (size, _) in sorted(entries.items(), key=lambda e: e[1][1]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.invalidate(key)
+            total -= size
+
+    def invalidate(self, key):
+        for name in self._entry_files(key):
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, name))
+
+    def _entry_files(self, key):
+        return [name for name in os.listdir(self.cache_dir) if name.split('.', 1)[0] == key]
+
+
+def build_cache(cache_dir, max_mb=None):
+    """Create a ``TokenCache`` from command line options, or ``None`` if disabled."""
+    if not cache_dir:
+        return None
+    return TokenCache(cache_dir, None if max_mb is None else int(max_mb * 2 ** 20))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Inspect or clear a token cache directory')
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('--clear', action='store_true', help='Delete every cached entry')
+    args = parser.parse_args()
+    cache = TokenCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+    names = os.listdir(args.cache_dir)
+    size = sum(os.path.getsize(os.path.join(args.cache_dir, n)) for n in names)
+    print(f"{len({n.split('.', 1)[0] for n in names})} entries, {size / 2 ** 20:.1f} MB")
@@ -0,0 +1,105 @@
+import os
+import threading
+import torch
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """Load a checkpoint written by ``torch.save`` as a memory-mapped file.
+
+    Tensor storages are mapped instead of read up front, so large
+    checkpoints open quickly and pages are only read when a tensor is used.
+    """
+    return torch.load(path, map_location=map_location, mmap=True)
+
+
+def _snapshot(obj):
+    """Copy every tensor in a nested state to the CPU."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def latest_checkpoint(ckpt_dir):
+    """Return the newest checkpoint in ``ckpt_dir``, or ``None``."""
+    if not os.path.isdir(ckpt_dir):
+        return None
+    names = sorted(n for n in os.listdir(ckpt_dir) if n.startswith('ckpt_') and n.endswith('.pt'))
+    return os.path.join(ckpt_dir, names[-1]) if names else None
+
+
+def resolve_resume(path):
+    """Map a ``--resume`` value (a file or a checkpoint directory) to a file."""
+    if os.path.isdir(path):
+        found = latest_checkpoint(path)
+        if found is None:
+            raise FileNotFoundError(f'No checkpoint found in {path}')
+        return found
+    return path
+
+
+class CheckpointWriter:
+    """Save training state from a background thread.
+
+    ``save`` copies the state to the CPU and returns; a thread then writes
+    ``ckpt_<step>.pt`` to a temporary file, renames it into place and deletes
+    all but the newest ``keep`` checkpoints. At most one write is in flight: a
+    new ``save`` first waits for the previous one. Errors raised by a write are
+    re-raised by the next ``save`` or ``close``.
+    """
+    def __init__(self, ckpt_dir, keep=3):
+        self.ckpt_dir = ckpt_dir
+        self.keep = keep
+        self._thread = None
+        self._error = None
+        os.makedirs(ckpt_dir, exist_ok=True)
+
+    def save(self, state, step):
+        self.wait()
+        snapshot = _snapshot(state)
+        path = os.path.join(self.ckpt_dir, f'ckpt_{step:08d}.pt')
+        self._thread = threading.Thread(target=self._write, args=(snapshot, path), daemon=True)
+        self._thread.start()
+        return path
+
+    def _write(self, snapshot, path):
+        try:
+            torch.save(snapshot, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            self._rotate()
+        except Exception as e:
+            self._error = e
+
+    def _rotate(self):
+        if not self.keep:
+            return
+        names = sorted(n for n in os.listdir(self.ckpt_dir)
+                       if n.startswith('ckpt_') and n.endswith('.pt'))
+        for name in names[:-self.keep]:
+            os.remove(os.path.join(self.ckpt_dir, name))
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    close = wait
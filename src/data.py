@@ -1,38 +1,202 @@
-import torch
-from torch.utils.data import Dataset, DataLoader
+import argparse
+import json
+import os
+import uuid
+from array import array
 from collections import Counter
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 
-class TextDataset(Dataset):
-    def __init__(self, path, seq_len=32, min_freq=1):
-        with open(path, 'r', encoding='utf-8') as f:
-            sentences = [line.strip() for line in f if line.strip()]
-
-        token_lists = [s.split() for s in sentences]
-        counter = Counter(tok for toks in token_lists for tok in toks)
-        self.vocab = {
-            token: i + 2
-            for i, (token, freq) in enumerate(counter.items())
-            if freq >= min_freq
+
+def build_vocab(counter, min_freq=1, voc_limit=None):
+    """Map tokens to ids by descending frequency, after the special tokens.
+
+    Ties are broken alphabetically and at most ``voc_limit`` tokens are kept,
+    as JoeyNMT does for its ``voc_limit``; the rest become ``<unk>``. Frequent
+    tokens get small ids, which the adaptive softmax head relies on.
+    """
+    vocab = {'<pad>': 0, '<unk>': 1}
+    tokens = sorted((tok for tok, freq in counter.items() if freq >= min_freq and tok not in vocab),
+                    key=lambda tok: (-counter[tok], tok))
+    for token in tokens[:voc_limit]:
+        vocab[token] = len(vocab)
+    return vocab
+
+
+def _temp_file(path, binary=True):
+    """Open a uniquely named file next to ``path`` that is later moved onto it."""
+    tmp = f'{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp'
+    if binary:
+        return open(tmp, 'xb'), tmp
+    return open(tmp, 'x', encoding='utf-8'), tmp
+
+
+def preprocess(path, output=None, min_freq=1, voc_limit=None):
+    """Tokenize ``path`` once into a flat, memory-mappable corpus.
+
+    Writes ``<output>.bin`` with every token id back to back (uint16 when the
+    vocabulary allows it, uint32 otherwise), ``<output>.idx`` with the int64
+    offset of each sentence start plus the total length, and
+    ``<output>.meta.json`` with the vocabulary. ``output`` defaults to ``path``.
+    Each file is written under a temporary name and moved into place, so a
+    process that has the old files mapped keeps reading intact data.
+    """
+    output = output or path
+    counter = Counter()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            counter.update(line.split())
+    vocab = build_vocab(counter, min_freq, voc_limit)
+    dtype = np.uint16 if len(vocab) <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+    offsets = array('q', [0])
+    temps = []
+    try:
+        out, tmp = _temp_file(output + '.bin')
+        temps.append(tmp)
+        with open(path, 'r', encoding='utf-8') as f, out:
+            for line in f:
+                tokens = line.split()
+                if not tokens:
+                    continue
+                ids = np.fromiter((vocab.get(tok, 1) for tok in tokens), dtype=dtype,
+                                  count=len(tokens))
+                out.write(ids.tobytes())
+                offsets.append(offsets[-1] + len(tokens))
+        f, tmp = _temp_file(output + '.idx')
+        temps.append(tmp)
+        with f:
+            offsets.tofile(f)
+
+        stat = os.stat(path)
+        meta = {
+            'vocab': vocab,
+            'dtype': np.dtype(dtype).name,
+            'min_freq': min_freq,
+            'voc_limit': voc_limit,
+            'vocab_order': 'frequency',
+            'source_size': stat.st_size,
+            'source_mtime': stat.st_mtime,
         }
-        self.vocab['<pad>'] = 0
-        self.vocab['<unk>'] = 1
+        f, tmp = _temp_file(output + '.meta.json', binary=False)
+        temps.append(tmp)
+        with f:
+            json.dump(meta, f)
+    except BaseException:
+        for tmp in temps:
+            os.remove(tmp)
+        raise
+    # the metadata goes last so an interrupted run is never mistaken for a finished one
+    for tmp, suffix in zip(temps, ('.bin', '.idx', '.meta.json')):
+        os.replace(tmp, output + suffix)
+    return output
+
+
+def _load_meta(prefix, path, min_freq, voc_limit=None):
+    """Return the metadata of an up-to-date preprocessed corpus, else ``None``."""
+    try:
+        with open(prefix + '.meta.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if path == prefix + '.bin':
+        return meta
+    # corpora preprocessed before vocabularies were frequency-ordered are rebuilt
+    if (meta['min_freq'], meta.get('voc_limit'), meta.get('vocab_order')) != \
+            (min_freq, voc_limit, 'frequency'):
+        return None
+    if os.path.exists(path):
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime) != (meta['source_size'], meta['source_mtime']):
+            return None
+    return meta
+
+
+class TextDataset(Dataset):
+    """Stride-1 language modelling windows over a memory-mapped token array.
+
+    ``path`` is either a plain text corpus, which is preprocessed next to
+    itself on first use, or the ``.bin`` file written by ``preprocess``.
+    Samples are views into the mapped file, so memory use stays close to the
+    size of the corpus and reruns start without re-tokenizing. With a
+    ``TokenCache`` the preprocessed files are kept in the cache directory,
+    keyed by the corpus content, instead of next to the corpus. ``min_freq``
+    and ``voc_limit`` are ignored for a ``.bin`` file, which keeps the
+    vocabulary it was written with.
+    """
+    def __init__(self, path, seq_len=32, min_freq=1, cache=None, voc_limit=None):
+        if cache is not None:
+            key = cache.key([path], kind='lm', min_freq=min_freq, voc_limit=voc_limit)
+            prefix = cache.path(key)
+            meta = _load_meta(prefix, prefix + '.bin', min_freq, voc_limit)
+            if meta is None:
+                preprocess(path, prefix, min_freq, voc_limit)
+                cache.evict(keep=key)
+                meta = _load_meta(prefix, prefix + '.bin', min_freq, voc_limit)
+            else:
+                cache.touch(key)
+        else:
+            prefix = path[:-len('.bin')] if path.endswith('.bin') else path
+            meta = _load_meta(prefix, path, min_freq, voc_limit)
+            if meta is None:
+                preprocess(path, prefix, min_freq, voc_limit)
+                meta = _load_meta(prefix, path, min_freq, voc_limit)
+
+        self.vocab = meta['vocab']
         self.inv_vocab = {i: t for t, i in self.vocab.items()}
         self.seq_len = seq_len
-        self.data = []
-        for tokens in token_lists:
-            ids = [self.vocab.get(tok, 1) for tok in tokens]
-            for i in range(0, len(ids) - seq_len):
-                self.data.append((ids[i:i+seq_len], ids[i+1:i+seq_len+1]))
+        # copy-on-write mapping: pages are shared with the file and torch
+        # does not warn about read-only arrays
+        self.tokens = np.memmap(prefix + '.bin', dtype=meta['dtype'], mode='c')
+        self.offsets = np.fromfile(prefix + '.idx', dtype=np.int64)
+        # each sentence of length n contributes n - seq_len windows
+        windows = np.maximum(np.diff(self.offsets) - seq_len, 0)
+        self.window_ends = np.cumsum(windows)
 
     def __len__(self):
-        return len(self.data)
+        return int(self.window_ends[-1]) if len(self.window_ends) else 0
 
     def __getitem__(self, idx):
-        src, tgt = self.data[idx]
-        return torch.tensor(src), torch.tensor(tgt)
+        sent = int(np.searchsorted(self.window_ends, idx, side='right'))
+        first = int(self.window_ends[sent - 1]) if sent else 0
+        start = int(self.offsets[sent]) + idx - first
+        chunk = torch.from_numpy(self.tokens[start:start + self.seq_len + 1])
+        return chunk[:-1], chunk[1:]
 
 
-def build_dataloader(path, seq_len=32, batch_size=32, min_freq=1):
-    dataset = TextDataset(path, seq_len, min_freq)
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+def build_dataloader(path, seq_len=32, batch_size=32, min_freq=1, cache=None,
+                     num_replicas=1, rank=0, seed=0, voc_limit=None):
+    dataset = TextDataset(path, seq_len, min_freq, cache, voc_limit)
+    # one seeded permutation shared by all processes, each taking a slice;
+    # the last len(dataset) % num_replicas windows of it are left out rather
+    # than padded with repeated ones
+    sampler = DistributedSampler(dataset, num_replicas, rank, shuffle=True, seed=seed,
+                                 drop_last=True)
+    loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler)
     return dataset, loader
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Preprocess a text corpus into a memory-mapped token file'
+    )
+    parser.add_argument(
+        '--corpus', type=str, required=True,
+        help='Path to the text corpus'
+    )
+    parser.add_argument(
+        '--output', type=str, default=None,
+        help='Output prefix (defaults to the corpus path)'
+    )
+    parser.add_argument(
+        '--min-freq', type=int, default=1,
+        help='Minimum token frequency kept in the vocabulary'
+    )
+    parser.add_argument(
+        '--voc-limit', type=int, default=None,
+        help='Keep only the most frequent tokens, e.g. 4000 as in the JoeyNMT configs'
+    )
+    args = parser.parse_args()
+    prefix = preprocess(args.corpus, args.output, args.min_freq, args.voc_limit)
+    print('Wrote', prefix + '.bin')
@@ -0,0 +1,71 @@
+import contextlib
+import os
+import socket
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def launch(fn, args, world_size=1):
+    """Run ``fn(rank, world_size, args)`` in ``world_size`` processes.
+
+    With more than one process a gloo process group is set up on localhost
+    and the machine's cores are split evenly between the processes, so they
+    do not oversubscribe each other's threads. A single process runs ``fn``
+    in place without a process group.
+    """
+    if world_size <= 1:
+        return fn(0, 1, args)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    mp.spawn(_run, args=(fn, world_size, port, args), nprocs=world_size)
+
+
+def _run(rank, fn, world_size, port, args):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    try:
+        fn(rank, world_size, args)
+    finally:
+        dist.destroy_process_group()
+
+
+def is_main():
+    """True in the process that should log and save."""
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+@contextlib.contextmanager
+def main_first():
+    """Run the body in the main process first and then in the others.
+
+    Whatever the main process builds on disk (preprocessed corpora, cache
+    entries, vocabulary files) is complete before the other processes open
+    it, instead of every process writing the same files at once.
+    """
+    distributed = dist.is_initialized()
+    if distributed and not is_main():
+        dist.barrier()
+    yield
+    if distributed and is_main():
+        dist.barrier()
+
+
+def all_reduce_sum(*values):
+    """Sum numbers across processes; returns floats, unchanged without a group."""
+    if not dist.is_initialized():
+        return [float(v) for v in values] if len(values) > 1 else float(values[0])
+    t = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.tolist() if len(values) > 1 else t.item()
+
+
+def all_reduce_max(value):
+    if not dist.is_initialized():
+        return float(value)
+    t = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.MAX)
+    return t.item()
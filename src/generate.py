@@ -1,21 +1,35 @@
 import argparse
 import torch
-from .model import TransformerLM, generate_square_subsequent_mask
+from .model import TransformerLM
+from .checkpoint import load_checkpoint
+from .quantize import quantize_dynamic, save_quantized
 
 
-def load_model(model_path, d_model, nhead, num_layers, dim_ff, dropout, device):
-    checkpoint = torch.load(model_path, map_location=device)
+def load_model(model_path, d_model, nhead, num_layers, dim_ff, dropout, device, quantize=None):
+    checkpoint = load_checkpoint(model_path)
+    # int8 dynamic quantization only runs on the CPU
+    if quantize or checkpoint.get('quantize'):
+        device = torch.device('cpu')
     vocab = checkpoint['vocab']
+    # the output head is recorded in the checkpoint; older ones are dense
     model = TransformerLM(
-        len(vocab), d_model, nhead, num_layers, dim_ff, dropout
+        len(vocab), d_model, nhead, num_layers, dim_ff, dropout,
+        checkpoint.get('cutoffs'), checkpoint.get('div_value', 4.0)
     ).to(device)
-    model.load_state_dict(checkpoint['model_state_dict'])
     model.eval()
+    # quantized checkpoints need the quantized modules before loading
+    if checkpoint.get('quantize'):
+        quantize_dynamic(model)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    if quantize and not checkpoint.get('quantize'):
+        quantize_dynamic(model)
     inv_vocab = {i: t for t, i in vocab.items()}
+    # older checkpoints do not record the training length
+    model.context_len = checkpoint.get('seq_len', model.pos_encoder.pe.size(1))
     return model, vocab, inv_vocab
 
 
-def generate(model, vocab, inv_vocab, prompt, length, temperature, device):
+def generate(model, vocab, inv_vocab, prompt, length, temperature, device, context_len=None):
     tokens = prompt.split()
     if tokens:
         ids = [vocab.get(t, vocab['<unk>']) for t in tokens]
@@ -25,15 +39,27 @@ def generate(model, vocab, inv_vocab, prompt, length, temperature, device):
         choices = [i for i in range(len(vocab)) if i not in specials]
         ids = [choices[0] if choices else vocab['<unk>']]
 
-    for _ in range(length):
-        inp = torch.tensor([ids], dtype=torch.long, device=device)
-        mask = generate_square_subsequent_mask(inp.size(1)).to(device)
-        with torch.no_grad():
-            out = model(inp, mask)
-        next_token_logits = out[0, -1] / temperature
-        probs = torch.softmax(next_token_logits, dim=-1)
-        next_id = torch.multinomial(probs, 1).item()
-        ids.append(next_id)
+    max_context = model.pos_encoder.pe.size(1)
+    context_len = min(context_len or getattr(model, 'context_len', max_context), max_context)
+    # positions are absolute, so once the window is full the cache is rebuilt
+    # from the most recent half of it; this happens every context_len // 2 tokens
+    keep = max(1, context_len // 2)
+    with torch.no_grad():
+        cache = model.init_cache()
+        out = model.forward_step(torch.tensor([ids[-context_len:]], dtype=torch.long, device=device), cache)
+        for step in range(length):
+            next_token_logits = out[0, -1] / temperature
+            probs = torch.softmax(next_token_logits, dim=-1)
+            next_id = torch.multinomial(probs, 1).item()
+            ids.append(next_id)
+            if step == length - 1:
+                break
+            if cache['pos'] >= context_len:
+                cache = model.init_cache()
+                inp = torch.tensor([ids[-keep:]], dtype=torch.long, device=device)
+            else:
+                inp = torch.tensor([[next_id]], dtype=torch.long, device=device)
+            out = model.forward_step(inp, cache)
 
     return " ".join(inv_vocab.get(i, "<unk>") for i in ids)
 
@@ -44,20 +70,38 @@ def main():
     parser.add_argument('--prompt', type=str, default='', help='Seed text to start generation')
     parser.add_argument('--length', type=int, default=20, help='Number of tokens to generate')
     parser.add_argument('--temperature', type=float, default=1.0, help='Sampling temperature')
+    parser.add_argument('--context-len', type=int, default=None,
+                        help='Maximum context attended to (defaults to the training sequence length)')
     # architecture parameters (should match training)
     parser.add_argument('--d-model', type=int, default=128)
     parser.add_argument('--nhead', type=int, default=4)
     parser.add_argument('--num-layers', type=int, default=2)
     parser.add_argument('--dim-ff', type=int, default=512)
     parser.add_argument('--dropout', type=float, default=0.1)
+    parser.add_argument('--quantize', choices=['int8'], default=None,
+                        help='Apply dynamic int8 quantization to the linear layers (CPU)')
+    parser.add_argument('--save-quantized', type=str, default=None,
+                        help='Save the quantized model to this path (implies --quantize int8)')
 
     args = parser.parse_args()
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if args.save_quantized and not args.quantize:
+        # there is nothing to save without quantizing first
+        args.quantize = 'int8'
+    if args.quantize:
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     model, vocab, inv_vocab = load_model(
-        args.model, args.d_model, args.nhead, args.num_layers, args.dim_ff, args.dropout, device
+        args.model, args.d_model, args.nhead, args.num_layers, args.dim_ff, args.dropout, device,
+        args.quantize
     )
-    text = generate(model, vocab, inv_vocab, args.prompt, args.length, args.temperature, device)
+    # quantized checkpoints are always loaded on the CPU
+    device = next(model.parameters()).device
+    if args.save_quantized:
+        save_quantized(model, load_checkpoint(args.model), args.save_quantized)
+    text = generate(model, vocab, inv_vocab, args.prompt, args.length, args.temperature, device,
+                    args.context_len)
     print(text)
 
 
@@ -0,0 +1,220 @@
+import argparse
+import contextlib
+import functools
+import itertools
+import json
+import operator
+import os
+import time
+from multiprocessing import Pool
+
+
+class Metrics:
+    """Token accuracy, exact match and per-length-bucket counts of predictions.
+
+    Predictions and references are token sequences, either strings or ids.
+    A reference token is correct when the prediction has the same token at
+    the same position, so a prediction that drops or inserts a token loses
+    the rest of the sentence. Examples are bucketed by reference length in
+    steps of ``bucket_width`` tokens (1-5, 6-10, ...).
+    """
+    def __init__(self, bucket_width=5):
+        self.bucket_width = bucket_width
+        # bucket index -> [examples, exact, correct tokens, reference tokens];
+        # the totals are sums over the buckets
+        self.buckets = {}
+
+    def add(self, pred, ref):
+        """Count one example and return whether it is an exact match."""
+        n = len(ref)
+        exact = pred == ref
+        bucket = (n - 1) // self.bucket_width if n else 0
+        counts = self.buckets.get(bucket)
+        if counts is None:
+            counts = self.buckets[bucket] = [0, 0, 0, 0]
+        counts[0] += 1
+        counts[3] += n
+        if exact:
+            counts[1] += 1
+            counts[2] += n
+        else:
+            counts[2] += sum(map(operator.eq, pred, ref))
+        return exact
+
+    def merge(self, other):
+        for bucket, counts in other.buckets.items():
+            mine = self.buckets.setdefault(bucket, [0, 0, 0, 0])
+            for i, c in enumerate(counts):
+                mine[i] += c
+        return self
+
+    def _total(self, i):
+        return sum(counts[i] for counts in self.buckets.values())
+
+    @property
+    def examples(self):
+        return self._total(0)
+
+    @property
+    def exact(self):
+        return self._total(1)
+
+    @property
+    def correct_tokens(self):
+        return self._total(2)
+
+    @property
+    def ref_tokens(self):
+        return self._total(3)
+
+    @property
+    def token_accuracy(self):
+        total = self.ref_tokens
+        return self.correct_tokens / total if total else 0.0
+
+    @property
+    def exact_match(self):
+        examples = self.examples
+        return self.exact / examples if examples else 0.0
+
+    def bucket_rows(self):
+        """Yield ``(label, examples, exact_match, token_accuracy)`` by length."""
+        for bucket in sorted(self.buckets):
+            n, exact, correct, total = self.buckets[bucket]
+            lo = bucket * self.bucket_width + 1
+            yield (f'{lo}-{lo + self.bucket_width - 1}', n, exact / n,
+                   correct / total if total else 0.0)
+
+    def as_dict(self):
+        return {
+            'examples': self.examples,
+            'token_accuracy': self.token_accuracy,
+            'exact_match': self.exact_match,
+            'buckets': [{'length': label, 'examples': n, 'exact_match': em, 'token_accuracy': acc}
+                        for label, n, em, acc in self.bucket_rows()],
+        }
+
+    def report(self):
+        lines = [f'examples: {self.examples}',
+                 f'token accuracy: {100 * self.token_accuracy:.2f}%',
+                 f'exact match: {100 * self.exact_match:.2f}%',
+                 f"{'ref length':>12}{'examples':>10}{'exact':>10}{'tokens':>10}"]
+        for label, n, em, acc in self.bucket_rows():
+            lines.append(f'{label:>12}{n:10d}{100 * em:9.2f}%{100 * acc:9.2f}%')
+        return '\n'.join(lines)
+
+
+class MismatchWriter:
+    """Write up to ``limit`` mismatched examples to ``path`` as JSON lines."""
+    def __init__(self, path, limit=1000):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.limit = limit
+        self.written = 0
+
+    def write(self, line, src, ref, pred):
+        if self.written >= self.limit:
+            return
+        record = {'line': line, 'src': src, 'ref': ref, 'pred': pred}
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.written += 1
+
+    def close(self):
+        self.file.close()
+
+
+def _score_chunk(chunk, bucket_width=5, keep_mismatches=0):
+    start, rows = chunk
+    metrics = Metrics(bucket_width)
+    mismatches = []
+    for offset, (ref, pred, *src) in enumerate(rows):
+        ref_tokens = ref.split()
+        # identical lines need not be split twice
+        pred_tokens = ref_tokens if pred == ref else pred.split()
+        if not metrics.add(pred_tokens, ref_tokens) and len(mismatches) < keep_mismatches:
+            mismatches.append((start + offset + 1, src[0].strip() if src else None,
+                               ref.strip(), pred.strip()))
+    return metrics, mismatches
+
+
+def _read_chunks(files, size):
+    """Yield ``(first line index, rows)`` chunks of lines read from ``files`` in lockstep."""
+    rows = itertools.zip_longest(*files)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        if None in chunk[-1]:
+            raise ValueError('source, reference and prediction files have different lengths')
+        yield start, chunk
+        start += len(chunk)
+
+
+def score_files(ref_path, pred_path, src_path=None, workers=None, chunk_size=20000,
+                bucket_width=5, mismatches=None, max_mismatches=1000):
+    """Score a prediction file against a reference file, one sentence per line.
+
+    The files are streamed in chunks that a pool of ``workers`` processes
+    scores in parallel. Up to ``max_mismatches`` mismatched examples are
+    written to the ``mismatches`` file as JSON lines, with their line number
+    and source sentence when ``src_path`` is given. Returns the ``Metrics``.
+    """
+    workers = workers or os.cpu_count()
+    writer = MismatchWriter(mismatches, max_mismatches) if mismatches else None
+    score = functools.partial(_score_chunk, bucket_width=bucket_width,
+                              keep_mismatches=max_mismatches if writer else 0)
+    metrics = Metrics(bucket_width)
+    with open(ref_path, encoding='utf-8') as rf, open(pred_path, encoding='utf-8') as pf, \
+            (open(src_path, encoding='utf-8') if src_path else contextlib.nullcontext()) as sf:
+        chunks = _read_chunks([rf, pf] + ([sf] if sf else []), chunk_size)
+        pool = Pool(workers) if workers > 1 else None
+        try:
+            for part, found in (pool.imap(score, chunks) if pool else map(score, chunks)):
+                metrics.merge(part)
+                if writer:
+                    for row in found:
+                        writer.write(*row)
+        finally:
+            if pool:
+                pool.terminate()
+            if writer:
+                writer.close()
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Token accuracy, exact match and per-length accuracy of a prediction file'
+    )
+    parser.add_argument('--ref', required=True, help='Reference file, one sentence per line')
+    parser.add_argument('--pred', required=True, help='Prediction file, aligned with --ref')
+    parser.add_argument('--src', type=str, default=None,
+                        help='Source file, only used to annotate mismatches')
+    parser.add_argument('--mismatches', type=str, default=None,
+                        help='Write mismatched examples to this file as JSON lines')
+    parser.add_argument('--max-mismatches', type=int, default=1000,
+                        help='Most mismatches written to --mismatches')
+    parser.add_argument('--bucket-width', type=int, default=5,
+                        help='Reference length range of each accuracy bucket')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Scoring processes (default: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=20000,
+                        help='Lines sent to a worker at a time')
+    parser.add_argument('--json', type=str, default=None,
+                        help='Also write the metrics to this file as JSON')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    try:
+        metrics = score_files(args.ref, args.pred, args.src, args.workers, args.chunk_size,
+                              args.bucket_width, args.mismatches, args.max_mismatches)
+    except ValueError as e:
+        parser.error(str(e))
+    print(metrics.report())
+    print(f'scored in {time.perf_counter() - start:.2f}s')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(metrics.as_dict(), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
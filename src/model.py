@@ -1,9 +1,20 @@
+import functools
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class TransformerLM(nn.Module):
-    def __init__(self, vocab_size, d_model=128, nhead=4, num_layers=2, dim_feedforward=512, dropout=0.1):
+    """Causal Transformer language model.
+
+    With ``cutoffs`` the dense ``fc_out`` projection is replaced by an
+    ``nn.AdaptiveLogSoftmaxWithLoss`` head: ids below ``cutoffs[0]`` form the
+    head and each further range a tail cluster whose projection is
+    ``div_value`` times narrower. Vocabularies must then be frequency-ordered
+    (see ``build_vocab``) so rare tokens land in the cheap clusters.
+    """
+    def __init__(self, vocab_size, d_model=128, nhead=4, num_layers=2, dim_feedforward=512, dropout=0.1,
+                 cutoffs=None, div_value=4.0):
         super().__init__()
         self.model_type = 'Transformer'
         self.d_model = d_model
@@ -17,14 +28,61 @@ class TransformerLM(nn.Module):
             batch_first=True,
         )
         self.transformer = nn.TransformerEncoder(encoder_layer, num_layers)
-        self.fc_out = nn.Linear(d_model, vocab_size)
+        if cutoffs:
+            self.fc_out = None
+            self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(d_model, vocab_size, list(cutoffs),
+                                                          div_value)
+        else:
+            self.fc_out = nn.Linear(d_model, vocab_size)
+            self.adaptive = None
+
+    def forward(self, src, src_mask=None, is_causal=False, targets=None):
+        """Return logits for ``src``, or the mean loss against ``targets``.
 
-    def forward(self, src, src_mask=None):
+        With ``is_causal=True`` every position only attends to itself and
+        earlier positions; ``src_mask`` may then be omitted, and attention
+        runs the fused causal kernel instead of applying a mask. With the
+        adaptive head the logits are full-vocabulary log-probabilities, and
+        the loss only evaluates the clusters of ``targets``.
+        """
+        if is_causal and src_mask is None:
+            src_mask = causal_mask(src.size(1), src.device)
         src = self.embedding(src) * math.sqrt(self.d_model)
         src = self.pos_encoder(src)
-        output = self.transformer(src, mask=src_mask)
-        output = self.fc_out(output)
-        return output
+        output = self.transformer(src, mask=src_mask, is_causal=is_causal)
+        if targets is None:
+            return self.output(output)
+        if self.adaptive is not None:
+            return self.adaptive(output.reshape(-1, self.d_model), targets.reshape(-1)).loss
+        return F.cross_entropy(self.fc_out(output).flatten(0, -2), targets.reshape(-1))
+
+    def output(self, x):
+        """Project hidden states onto the vocabulary."""
+        if self.adaptive is None:
+            return self.fc_out(x)
+        return self.adaptive.log_prob(x.reshape(-1, self.d_model)).view(*x.shape[:-1], -1)
+
+    def init_cache(self):
+        """Return an empty key/value cache for ``forward_step``."""
+        return {'pos': 0, 'layers': [{'k': None, 'v': None} for _ in self.transformer.layers]}
+
+    def forward_step(self, src, cache):
+        """Return logits for the new tokens ``src`` given the tokens in ``cache``.
+
+        Matches the last ``src.size(1)`` positions of ``forward`` with a causal
+        mask over the whole prefix, but only the new tokens are run through
+        the layers. ``cache`` is updated in place.
+        """
+        past = cache['pos']
+        x = self.embedding(src) * math.sqrt(self.d_model)
+        x = self.pos_encoder(x, offset=past)
+        mask = step_attention_mask(past, src.size(1), device=src.device)
+        for layer, layer_cache in zip(self.transformer.layers, cache['layers']):
+            x = _encoder_layer_step(layer, x, layer_cache, mask)
+        if self.transformer.norm is not None:
+            x = self.transformer.norm(x)
+        cache['pos'] = past + src.size(1)
+        return self.output(x)
 
 class PositionalEncoding(nn.Module):
     def __init__(self, d_model, dropout=0.1, max_len=5000):
@@ -38,9 +96,10 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
+    def forward(self, x, offset=0):
         # x shape: (batch, seq_len, d_model) when batch_first=True
-        x = x + self.pe[:, :x.size(1)]
+        # offset is the position of x[:, 0] when decoding step by step
+        x = x + self.pe[:, offset:offset + x.size(1)]
         return self.dropout(x)
 
 
@@ -48,3 +107,97 @@ def generate_square_subsequent_mask(sz):
     """Return an upper-triangular matrix of -inf, 0.0 for masking future tokens."""
     mask = torch.triu(torch.full((sz, sz), float('-inf')), diagonal=1)
     return mask
+
+
+@functools.lru_cache(maxsize=64)
+def causal_mask(sz, device=None):
+    """Boolean mask that is ``True`` for future tokens, cached per size and device.
+
+    Shared between calls, so it must not be modified in place.
+    """
+    return torch.ones(sz, sz, dtype=torch.bool, device=device).triu(1)
+
+
+def pad_packed(x, keep):
+    """Scatter the rows of ``x`` to the ``True`` positions of ``keep``, zeros elsewhere.
+
+    Inverse of ``x[keep]``: turns (tokens, dim) back into (batch, seq, dim).
+    """
+    out = x.new_zeros(*keep.shape, x.size(-1))
+    out[keep] = x
+    return out
+
+
+def split_heads(x, nhead):
+    """Reshape (batch, seq, d_model) into (batch, nhead, seq, head_dim)."""
+    batch, seq, d_model = x.shape
+    return x.view(batch, seq, nhead, d_model // nhead).transpose(1, 2)
+
+
+def merge_heads(x):
+    """Inverse of ``split_heads``."""
+    batch, nhead, seq, head_dim = x.shape
+    return x.transpose(1, 2).reshape(batch, seq, nhead * head_dim)
+
+
+def attention_projection(attn, x, part):
+    """Apply the query (0), key (1) or value (2) projection of ``attn``."""
+    d = attn.embed_dim
+    weight = attn.in_proj_weight[part * d:(part + 1) * d]
+    bias = None
+    if attn.in_proj_bias is not None:
+        bias = attn.in_proj_bias[part * d:(part + 1) * d]
+    return split_heads(F.linear(x, weight, bias), attn.num_heads)
+
+
+def self_attention_projection(attn, x):
+    """Project ``x`` into query, key and value heads with one matmul."""
+    qkv = F.linear(x, attn.in_proj_weight, attn.in_proj_bias)
+    return [split_heads(t, attn.num_heads) for t in qkv.chunk(3, dim=-1)]
+
+
+def cached_attention(attn, q, k, v, attn_mask=None, is_causal=False, keep=None):
+    """Attend with pre-split heads and apply the output projection of ``attn``.
+
+    ``attn_mask`` is boolean where ``True`` marks positions that may be
+    attended to, as expected by ``scaled_dot_product_attention``. With
+    ``keep``, only those query positions are projected and returned, packed
+    as (tokens, d_model).
+    """
+    dropout = attn.dropout if attn.training else 0.0
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout,
+                                         is_causal=is_causal)
+    out = merge_heads(out)
+    if keep is not None:
+        out = out[keep]
+    return attn.out_proj(out)
+
+
+def step_attention_mask(past_len, new_len, key_padding_mask=None, device=None):
+    """Boolean mask letting ``new_len`` queries see the cache and earlier new keys.
+
+    ``key_padding_mask`` is (batch, past_len + new_len) with ``True`` for
+    padding, following the ``nn.Transformer`` convention. Returns ``None``
+    when nothing needs masking so the fused attention kernel can be used.
+    """
+    mask = None
+    if new_len > 1:
+        rows = torch.arange(new_len, device=device).unsqueeze(1) + past_len
+        cols = torch.arange(past_len + new_len, device=device).unsqueeze(0)
+        mask = (cols <= rows).view(1, 1, new_len, past_len + new_len)
+    if key_padding_mask is not None and key_padding_mask.any():
+        keep = ~key_padding_mask.view(key_padding_mask.size(0), 1, 1, -1)
+        mask = keep if mask is None else mask & keep
+    return mask
+
+
+def _encoder_layer_step(layer, x, cache, mask):
+    """Run one post-norm ``nn.TransformerEncoderLayer`` on new positions only."""
+    q, k, v = self_attention_projection(layer.self_attn, x)
+    if cache['k'] is not None:
+        k = torch.cat([cache['k'], k], dim=2)
+        v = torch.cat([cache['v'], v], dim=2)
+    cache['k'], cache['v'] = k, v
+    x = layer.norm1(x + layer.dropout1(cached_attention(layer.self_attn, q, k, v, mask)))
+    ff = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+    return layer.norm2(x + layer.dropout2(ff))
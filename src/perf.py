@@ -0,0 +1,161 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+import torch
+
+
+def autocast(device, precision='fp32'):
+    """Return the autocast context for ``precision`` ('fp32' or 'bf16')."""
+    if precision == 'bf16':
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def maybe_compile(model, enabled=False):
+    """Wrap ``model`` with ``torch.compile`` when ``enabled``.
+
+    Shapes are compiled as dynamic from the start, so the varying batch and
+    sequence lengths produced by the collate functions reuse one graph
+    instead of recompiling for every new length. The returned module shares
+    parameters with ``model``; save ``model.state_dict()`` to keep
+    checkpoints free of the compile wrapper prefix.
+    """
+    if not enabled:
+        return model
+    return torch.compile(model, dynamic=True)
+
+
+class ThroughputMeter:
+    """Accumulate tokens and wall time per training step."""
+    def __init__(self):
+        self.tokens = 0
+        self.steps = 0
+        self.elapsed = 0.0
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+
+    def stop(self, tokens):
+        self.elapsed += time.perf_counter() - self._start
+        self.tokens += tokens
+        self.steps += 1
+
+    def summary(self):
+        tps = self.tokens / self.elapsed if self.elapsed else 0.0
+        step_ms = 1000 * self.elapsed / self.steps if self.steps else 0.0
+        return f"{tps:.0f} tokens/s, {step_ms:.1f} ms/step"
+
+
+def peak_memory_mb(device):
+    """Peak memory of this process: CUDA allocations on a GPU, else the max RSS."""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def rank_path(path, rank, world_size):
+    """Give every process of a distributed run its own output file."""
+    if world_size <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.rank{rank}{ext}'
+
+
+class StepRecorder:
+    """Time the phases of each training step and write them as JSON lines.
+
+    ``begin`` is called once the batch is in hand and records the time spent
+    waiting for it as ``data_ms``; ``phase`` blocks add to ``<name>_ms``; and
+    ``end`` adds the given fields (token counts, loss, ...) plus the peak
+    memory and writes the record to ``path``. Phases are also labelled for
+    ``torch.profiler`` traces. On CUDA the device is synchronized after each
+    phase so GPU time is charged to the phase that launched it. Without a
+    ``path`` nothing is timed or written, but phases are still labelled.
+    """
+    def __init__(self, path=None, device=None):
+        self.device = device
+        self.file = open(path, 'w', encoding='utf-8') if path else None
+        self.record = None
+        self._last = time.perf_counter()
+
+    def reset(self):
+        """Restart the data timer, e.g. at the start of an epoch."""
+        self._last = time.perf_counter()
+
+    def begin(self, **fields):
+        if self.file is None:
+            return
+        now = time.perf_counter()
+        self.record = dict(fields, data_ms=1000 * (now - self._last))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.file is None:
+            with torch.profiler.record_function(name):
+                yield
+            return
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+        key = name + '_ms'
+        self.record[key] = self.record.get(key, 0.0) + 1000 * (time.perf_counter() - start)
+
+    def end(self, **fields):
+        if self.file is None:
+            return
+        self.record.update(fields)
+        self.record['peak_mem_mb'] = peak_memory_mb(self.device)
+        record = {k: round(v, 3) if isinstance(v, float) else v for k, v in self.record.items()}
+        self.file.write(json.dumps(record) + '\n')
+        self.record = None
+        self._last = time.perf_counter()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class ProfileWindow:
+    """Capture a ``torch.profiler`` trace over a range of training steps.
+
+    ``spec`` is ``'START-END'`` (inclusive, counting optimizer steps from 1)
+    or a single step. Call ``step_started``/``step_finished`` with the step
+    number around every step; the Chrome trace of the window is written to
+    ``output`` and can be opened in Perfetto or ``chrome://tracing``.
+    """
+    def __init__(self, spec, output, device):
+        start, _, end = spec.partition('-')
+        self.start = int(start)
+        self.end = int(end or start)
+        self.output = output
+        self.device = device
+        self.profiler = None
+
+    def step_started(self, step):
+        if step == self.start and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.__enter__()
+
+    def step_finished(self, step):
+        if self.profiler is not None and step >= self.end:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(os.path.dirname(self.output) or '.', exist_ok=True)
+        self.profiler.export_chrome_trace(self.output)
+        self.profiler = None
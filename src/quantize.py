@@ -0,0 +1,112 @@
+import argparse
+import io
+import os
+import time
+import torch
+import torch.nn as nn
+from .checkpoint import load_checkpoint
+
+
+def _fastpath_off(module, args):
+    module._fastpath_enabled = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+
+
+def _fastpath_restore(module, args, output):
+    torch.backends.mha.set_fastpath_enabled(module._fastpath_enabled)
+
+
+def quantize_dynamic(model):
+    """Quantize every ``nn.Linear`` of ``model`` to int8 in place, for CPU inference.
+
+    Weights are stored as int8 and activations are quantized on the fly, so
+    no calibration data is needed. The attention output projections are
+    ``NonDynamicallyQuantizableLinear`` and stay in fp32, as do the packed
+    q/k/v projections. The fused ``nn.TransformerEncoderLayer`` inference
+    path cannot run quantized layers, so it is switched off while the
+    model's encoders run.
+    """
+    torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    for module in model.modules():
+        if isinstance(module, nn.TransformerEncoder):
+            module.register_forward_pre_hook(_fastpath_off)
+            module.register_forward_hook(_fastpath_restore, always_call=True)
+    model.quantize = 'int8'
+    return model
+
+
+def save_quantized(model, checkpoint, path):
+    """Save ``checkpoint`` with the quantized weights of ``model``.
+
+    The ``quantize`` entry tells the ``load_model`` functions to quantize
+    the freshly built model before loading the state dict.
+    """
+    if not getattr(model, 'quantize', None):
+        raise ValueError('save_quantized needs a model quantized with quantize_dynamic')
+    torch.save(dict(checkpoint, model_state_dict=model.state_dict(), quantize=model.quantize), path)
+
+
+def state_dict_bytes(model):
+    """Size of the serialized weights of ``model``."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+if __name__ == '__main__':
+    from .seq2seq.evaluate import load_model, load_tokenized_dataset, decode_dataset, token_accuracy
+
+    parser = argparse.ArgumentParser(
+        description='Compare fp32 and dynamic int8 inference of a seq2seq model'
+    )
+    parser.add_argument('--model', required=True, help='Path to trained model')
+    parser.add_argument('--src', type=str, default='data/scan/simple/test.src')
+    parser.add_argument('--tgt', type=str, default='data/scan/simple/test.tgt')
+    parser.add_argument('--d-model', type=int, default=128)
+    parser.add_argument('--nhead', type=int, default=4)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--dim-ff', type=int, default=512)
+    parser.add_argument('--dropout', type=float, default=0.1)
+    parser.add_argument('--eval-batch-size', type=int, default=1,
+                        help='Number of sentences decoded together')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Number of CPU threads (defaults to the torch default)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Save the quantized model to this path')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cpu')
+
+    results = {}
+    for precision in ('fp32', 'int8'):
+        model, src_vocab, tgt_vocab = load_model(
+            args.model, device, args.d_model, args.nhead, args.num_layers,
+            args.dim_ff, args.dropout, quantize=None if precision == 'fp32' else precision
+        )
+        dataset = load_tokenized_dataset(args.src, args.tgt, src_vocab, tgt_vocab)
+        start = time.perf_counter()
+        with torch.no_grad():
+            preds = decode_dataset(model, dataset, device, args.eval_batch_size)
+        elapsed = time.perf_counter() - start
+        results[precision] = {
+            'size': state_dict_bytes(model) / 2 ** 20,
+            'latency': 1000 * elapsed / len(dataset.data),
+            'accuracy': 100 * token_accuracy(dataset, preds),
+        }
+        if precision == 'int8' and args.output:
+            checkpoint = load_checkpoint(args.model)
+            save_quantized(model, checkpoint, args.output)
+            print('Quantized model saved to', args.output)
+
+    fp32, int8 = results['fp32'], results['int8']
+    print(f"{'':18}{'fp32':>10}{'int8':>10}{'change':>10}")
+    print(f"{'weights (MB)':18}{fp32['size']:10.2f}{int8['size']:10.2f}"
+          f"{int8['size'] / fp32['size'] - 1:10.1%}")
+    print(f"{'latency (ms/sent)':18}{fp32['latency']:10.2f}{int8['latency']:10.2f}"
+          f"{int8['latency'] / fp32['latency'] - 1:10.1%}")
+    print(f"{'accuracy (%)':18}{fp32['accuracy']:10.2f}{int8['accuracy']:10.2f}"
+          f"{int8['accuracy'] - fp32['accuracy']:+10.2f}")
+    if args.output:
+        print(f"Checkpoint size: {os.path.getsize(args.model) / 2 ** 20:.2f} MB -> "
+              f"{os.path.getsize(args.output) / 2 ** 20:.2f} MB")
@@ -1,16 +1,66 @@
+import json
+import os
+import random
+from array import array
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import (
+    Dataset, IterableDataset, Sampler, DataLoader, DistributedSampler, get_worker_info,
+)
 from collections import Counter
 
+
+def build_vocabs(src_counter, tgt_counter, min_freq=1):
+    """Build source and target vocabularies in first-seen token order."""
+    src_vocab = {'<pad>':0, '<unk>':1}
+    for tok, freq in src_counter.items():
+        if freq >= min_freq:
+            src_vocab.setdefault(tok, len(src_vocab))
+
+    tgt_vocab = {'<pad>':0, '<unk>':1, '<bos>':2, '<eos>':3}
+    for tok, freq in tgt_counter.items():
+        if freq >= min_freq:
+            tgt_vocab.setdefault(tok, len(tgt_vocab))
+    return src_vocab, tgt_vocab
+
+
+def save_vocab(path, src_vocab, tgt_vocab):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'src_vocab': src_vocab, 'tgt_vocab': tgt_vocab}, f)
+
+
+def load_vocab(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        vocabs = json.load(f)
+    return vocabs['src_vocab'], vocabs['tgt_vocab']
+
+
 class ParallelTextDataset(Dataset):
     """Dataset for parallel text files."""
-    def __init__(self, src_path, tgt_path, min_freq=1):
+    _ARRAYS = ('src_ids', 'tgt_ids', 'src_offsets', 'tgt_offsets')
+
+    def __init__(self, src_path, tgt_path, min_freq=1, cache=None):
         self.src_path = src_path
         self.tgt_path = tgt_path
 
-        # honour the minimum frequency parameter when building vocabularies
-        self.run(src_path, tgt_path, min_freq)
-        
+        if cache is None:
+            # honour the minimum frequency parameter when building vocabularies
+            self.run(src_path, tgt_path, min_freq)
+            return
+        key = cache.key([src_path, tgt_path], kind='parallel', min_freq=min_freq)
+        entry = cache.load(key)
+        if entry is None:
+            self.run(src_path, tgt_path, min_freq)
+            cache.store(key, {name: getattr(self, name) for name in self._ARRAYS},
+                        {'src_vocab': self.src_vocab, 'tgt_vocab': self.tgt_vocab})
+            return
+        arrays, meta = entry
+        for name in self._ARRAYS:
+            setattr(self, name, arrays[name])
+        self.src_vocab, self.tgt_vocab = meta['src_vocab'], meta['tgt_vocab']
+        self.src_unk_count = int((self.src_ids == 1).sum())
+        self.tgt_unk_count = int((self.tgt_ids == 1).sum())
+
     def run(self, src_path, tgt_path, min_freq=1):
         """Load data and build vocabularies."""
         with open(src_path, 'r', encoding='utf-8') as f:
@@ -19,47 +69,300 @@ class ParallelTextDataset(Dataset):
             tgt_lines = [l.strip() for l in f if l.strip()]
         assert len(src_lines) == len(tgt_lines), "Source and target files must have same number of lines"
 
-        self.src_tokens = [l.split() for l in src_lines]
-        self.tgt_tokens = [l.split() for l in tgt_lines]
-
-        src_counter = Counter(tok for sent in self.src_tokens for tok in sent)
-        tgt_counter = Counter(tok for sent in self.tgt_tokens for tok in sent)
-
-        self.src_vocab = {'<pad>':0, '<unk>':1}
-        for tok, freq in src_counter.items():
-            if freq >= min_freq:
-                self.src_vocab.setdefault(tok, len(self.src_vocab))
+        src_counter = Counter(tok for line in src_lines for tok in line.split())
+        tgt_counter = Counter(tok for line in tgt_lines for tok in line.split())
 
-        self.tgt_vocab = {'<pad>':0, '<unk>':1, '<bos>':2, '<eos>':3}
-        for tok, freq in tgt_counter.items():
-            if freq >= min_freq:
-                self.tgt_vocab.setdefault(tok, len(self.tgt_vocab))
+        self.src_vocab, self.tgt_vocab = build_vocabs(src_counter, tgt_counter, min_freq)
 
-        self.data = []
-        for s_tokens, t_tokens in zip(self.src_tokens, self.tgt_tokens):
-            src_ids = [self.src_vocab.get(tok, 1) for tok in s_tokens]
-            tgt_ids = [2] + [self.tgt_vocab.get(tok, 1) for tok in t_tokens] + [3]
-            self.data.append((src_ids, tgt_ids))
+        # all examples live in two flat int32 buffers; example i spans
+        # offsets[i]:offsets[i + 1]
+        src_ids, tgt_ids = array('i'), array('i')
+        src_offsets, tgt_offsets = array('q', [0]), array('q', [0])
+        for s_line, t_line in zip(src_lines, tgt_lines):
+            src_ids.extend(self.src_vocab.get(tok, 1) for tok in s_line.split())
+            src_offsets.append(len(src_ids))
+            tgt_ids.append(2)
+            tgt_ids.extend(self.tgt_vocab.get(tok, 1) for tok in t_line.split())
+            tgt_ids.append(3)
+            tgt_offsets.append(len(tgt_ids))
+        self.src_ids = np.frombuffer(src_ids, dtype=np.int32)
+        self.tgt_ids = np.frombuffer(tgt_ids, dtype=np.int32)
+        self.src_offsets = np.frombuffer(src_offsets, dtype=np.int64)
+        self.tgt_offsets = np.frombuffer(tgt_offsets, dtype=np.int64)
 
         # count unknown tokens so training script can report them
-        self.src_unk_count = sum(tok == 1 for src_ids, _ in self.data for tok in src_ids)
-        self.tgt_unk_count = sum(tok == 1 for _, tgt_ids in self.data for tok in tgt_ids)
+        self.src_unk_count = int((self.src_ids == 1).sum())
+        self.tgt_unk_count = int((self.tgt_ids == 1).sum())
 
     def __len__(self):
-        return len(self.data)
+        return len(self.src_offsets) - 1
 
     def __getitem__(self, idx):
-        return self.data[idx]
+        src = self.src_ids[self.src_offsets[idx]:self.src_offsets[idx + 1]]
+        tgt = self.tgt_ids[self.tgt_offsets[idx]:self.tgt_offsets[idx + 1]]
+        return src, tgt
+
+    def __getitems__(self, indices):
+        """Fetch a whole batch, already padded; ``DataLoader`` prefers this."""
+        indices = np.asarray(indices)
+        return PaddedBatch((_gather_padded(self.src_ids, self.src_offsets, indices),
+                            _gather_padded(self.tgt_ids, self.tgt_offsets, indices)))
+
+    def lengths(self):
+        """Return the (source, target) length of every example."""
+        return list(zip(np.diff(self.src_offsets).tolist(), np.diff(self.tgt_offsets).tolist()))
+
+
+class PaddedBatch(tuple):
+    """(src, tgt) tensors that were padded before reaching ``collate_fn``."""
+
+
+def _gather_padded(flat, offsets, indices, pad_idx=0):
+    """Copy the examples ``indices`` out of a flat id buffer into a padded tensor."""
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    cols = np.arange(lengths.max())
+    mask = cols < lengths[:, None]
+    padded = np.full((len(indices), len(cols)), pad_idx, dtype=np.int64)
+    padded[mask] = flat[(starts[:, None] + cols)[mask]]
+    return torch.from_numpy(padded)
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler that groups examples of similar length.
+
+    Every epoch the examples are shuffled and split into pools of
+    ``pool_size`` examples. Each pool is sorted by (source, target) length
+    and cut into batches, and the order of all batches is shuffled again.
+    A batch holds at most ``batch_size`` examples and, when ``max_tokens``
+    is given, at most ``max_tokens`` source plus target tokens after padding.
+    Call ``set_epoch`` before each epoch to get a new order. With
+    ``num_replicas`` > 1 every process builds the same batches and takes
+    every ``num_replicas``-th example of each, so a batch is split across
+    processes. Batches with fewer examples than processes (for instance a
+    long sentence that fills ``max_tokens`` alone) are pooled and regrouped
+    into batches of one example per process; the last fewer than
+    ``num_replicas`` of them are left out, and ``dropped`` counts them.
+    """
+    def __init__(self, lengths, batch_size=32, max_tokens=None, pool_size=None,
+                 shuffle=True, seed=0, num_replicas=1, rank=0):
+        if batch_size is None and max_tokens is None:
+            raise ValueError('BucketBatchSampler needs batch_size or max_tokens')
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size or 100 * (batch_size or 100)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.dropped = 0
+        self._cache = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        if self._cache is not None and self._cache[0] == self.epoch:
+            return self._cache[1]
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths), generator=generator).tolist()
+        else:
+            order = list(range(len(self.lengths)))
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            pool = sorted(order[start:start + self.pool_size], key=lambda i: self.lengths[i])
+            batch, src_len, tgt_len = [], 0, 0
+            for i in pool:
+                new_src = max(src_len, self.lengths[i][0])
+                new_tgt = max(tgt_len, self.lengths[i][1])
+                full = self.batch_size is not None and len(batch) == self.batch_size
+                over = (self.max_tokens is not None and batch
+                        and (len(batch) + 1) * (new_src + new_tgt) > self.max_tokens)
+                if full or over:
+                    batches.append(batch)
+                    batch = []
+                    new_src, new_tgt = self.lengths[i]
+                batch.append(i)
+                src_len, tgt_len = new_src, new_tgt
+            if batch:
+                batches.append(batch)
+        self.dropped = 0
+        if self.num_replicas > 1:
+            small = [i for b in batches if len(b) < self.num_replicas for i in b]
+            batches = [b for b in batches if len(b) >= self.num_replicas]
+            small.sort(key=lambda i: self.lengths[i])
+            usable = len(small) - len(small) % self.num_replicas
+            batches += [small[j:j + self.num_replicas] for j in range(0, usable, self.num_replicas)]
+            self.dropped = len(small) - usable
+        if self.shuffle:
+            perm = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in perm]
+        if self.num_replicas > 1:
+            batches = [b[self.rank::self.num_replicas] for b in batches]
+        self._cache = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        return len(self._batches())
+
+
+def _nonempty_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def _parallel_lines(src_path, tgt_path):
+    """Yield aligned (src, tgt) lines, reading both files lazily."""
+    src_lines = _nonempty_lines(src_path)
+    tgt_lines = _nonempty_lines(tgt_path)
+    for src_line in src_lines:
+        tgt_line = next(tgt_lines, None)
+        assert tgt_line is not None, "Source and target files must have same number of lines"
+        yield src_line, tgt_line
+    assert next(tgt_lines, None) is None, "Source and target files must have same number of lines"
+
+
+class StreamingParallelTextDataset(IterableDataset):
+    """Parallel text dataset that tokenizes lazily from the files.
+
+    A first pass over the files counts lines and tokens to build the
+    vocabularies (or, when ``vocab_path`` exists, to load them and count
+    ``<unk>`` tokens). Afterwards examples are read one line at a time, so
+    memory use does not depend on corpus size. With ``shuffle_buffer`` > 0
+    examples are shuffled within a buffer of that many examples. Each
+    ``DataLoader`` worker of each of the ``num_replicas`` processes reads its
+    own interleaved shard of the lines; with several processes the tail of
+    the corpus is dropped so every process gets the same number of lines.
+    """
+    def __init__(self, src_path, tgt_path, min_freq=1, vocab_path=None,
+                 shuffle_buffer=0, seed=0, num_replicas=1, rank=0):
+        self.src_path = src_path
+        self.tgt_path = tgt_path
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        src_counter = Counter()
+        tgt_counter = Counter()
+        self.num_lines = 0
+        for src_line, tgt_line in _parallel_lines(src_path, tgt_path):
+            src_counter.update(src_line.split())
+            tgt_counter.update(tgt_line.split())
+            self.num_lines += 1
+
+        if vocab_path is not None and os.path.exists(vocab_path):
+            self.src_vocab, self.tgt_vocab = load_vocab(vocab_path)
+        else:
+            self.src_vocab, self.tgt_vocab = build_vocabs(src_counter, tgt_counter, min_freq)
+            if vocab_path is not None:
+                save_vocab(vocab_path, self.src_vocab, self.tgt_vocab)
+
+        self.src_unk_count = sum(c for tok, c in src_counter.items() if tok not in self.src_vocab)
+        self.tgt_unk_count = sum(c for tok, c in tgt_counter.items() if tok not in self.tgt_vocab)
+
+    def set_epoch(self, epoch):
+        """Change the shuffle order; call before iterating each epoch."""
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_lines // self.num_replicas
+
+    def _examples(self, shard, num_shards):
+        limit = self.num_lines
+        if self.num_replicas > 1:
+            limit -= limit % num_shards
+        for i, (src_line, tgt_line) in enumerate(_parallel_lines(self.src_path, self.tgt_path)):
+            if i >= limit:
+                break
+            if i % num_shards != shard:
+                continue
+            src_ids = [self.src_vocab.get(tok, 1) for tok in src_line.split()]
+            tgt_ids = [2] + [self.tgt_vocab.get(tok, 1) for tok in tgt_line.split()] + [3]
+            yield src_ids, tgt_ids
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker else (0, 1)
+        shard = self.rank * num_workers + worker_id
+        num_shards = self.num_replicas * num_workers
+        examples = self._examples(shard, num_shards)
+        if self.shuffle_buffer <= 0:
+            yield from examples
+            return
+        rng = random.Random(hash((self.seed, self.epoch, shard)))
+        buffer = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = example
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def pad_batch(seqs, pad_idx=0):
+    """Right-pad id sequences into one (batch, max_len) long tensor."""
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    padded = np.full((len(seqs), lengths.max()), pad_idx, dtype=np.int64)
+    # one masked write fills every row at once
+    padded[np.arange(padded.shape[1]) < lengths[:, None]] = np.concatenate(seqs)
+    return torch.from_numpy(padded)
 
 def collate_fn(batch):
+    if isinstance(batch, PaddedBatch):
+        return tuple(batch)
     src_batch, tgt_batch = zip(*batch)
-    src_len = max(len(s) for s in src_batch)
-    tgt_len = max(len(t) for t in tgt_batch)
-    padded_src = [s + [0]*(src_len - len(s)) for s in src_batch]
-    padded_tgt = [t + [0]*(tgt_len - len(t)) for t in tgt_batch]
-    return torch.tensor(padded_src), torch.tensor(padded_tgt)
-
-def build_dataloader(src_path, tgt_path, batch_size=32, min_freq=1, shuffle=False):
-    dataset = ParallelTextDataset(src_path, tgt_path, min_freq)
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn)
+    return pad_batch(src_batch), pad_batch(tgt_batch)
+
+def build_dataloader(src_path, tgt_path, batch_size=32, min_freq=1, shuffle=False,
+                     streaming=False, vocab_path=None, shuffle_buffer=10000, num_workers=0,
+                     bucket=False, max_tokens=None, pin_memory=False, cache=None,
+                     num_replicas=1, rank=0, seed=0):
+    """Build a dataset and its loader.
+
+    ``num_replicas``/``rank`` shard the data for distributed training; each
+    process then gets batches of ``batch_size`` examples. Shuffling is
+    seeded by ``seed`` and the epoch set through ``set_epoch``.
+    """
+    if streaming and (bucket or max_tokens):
+        raise ValueError('Length bucketing is not supported in streaming mode')
+    if streaming:
+        dataset = StreamingParallelTextDataset(
+            src_path, tgt_path, min_freq, vocab_path,
+            shuffle_buffer if shuffle else 0, seed, num_replicas, rank)
+        loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn,
+                            num_workers=num_workers, pin_memory=pin_memory)
+        return dataset, loader
+    dataset = ParallelTextDataset(src_path, tgt_path, min_freq, cache)
+    if bucket or max_tokens:
+        # batches are built globally and split between processes
+        sampler = BucketBatchSampler(
+            dataset.lengths(),
+            None if batch_size is None else batch_size * num_replicas,
+            None if max_tokens is None else max_tokens * num_replicas,
+            shuffle=shuffle, seed=seed, num_replicas=num_replicas, rank=rank)
+        loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn,
+                            num_workers=num_workers, pin_memory=pin_memory)
+        return dataset, loader
+    sampler = None
+    if shuffle or num_replicas > 1:
+        # the same seeded permutation is split between processes, so one
+        # process with batch_size * N sees the same global batches as N; its
+        # last len(dataset) % N examples are left out rather than repeated
+        sampler = DistributedSampler(dataset, num_replicas, rank, shuffle=shuffle, seed=seed,
+                                     drop_last=True)
+    loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn,
+                        num_workers=num_workers, pin_memory=pin_memory)
     return dataset, loader
@@ -1,23 +1,90 @@
 import argparse
+import json
+import queue
+import threading
+import numpy as np
 import torch
 from .model import Seq2SeqTransformer
-from ..model import generate_square_subsequent_mask
+from .shortlist import Shortlist
+from ..cache import build_cache
+from ..checkpoint import load_checkpoint
+from ..metrics import Metrics, MismatchWriter
+from ..quantize import quantize_dynamic, save_quantized
 import tqdm
 
-def load_model(path, device, d_model, nhead, num_layers, dim_ff, dropout):
-    checkpoint = torch.load(path, map_location=device)
+def load_model(path, device, d_model, nhead, num_layers, dim_ff, dropout, quantize=None):
+    """Load a checkpoint, optionally applying dynamic int8 quantization (CPU only).
+
+    Checkpoints saved with ``save_quantized`` are quantized before their
+    weights are loaded, whatever ``quantize`` says. A quantized model is
+    always placed on the CPU, whatever ``device`` says; callers should take
+    the device from the returned model.
+    """
+    checkpoint = load_checkpoint(path)
+    if quantize or checkpoint.get('quantize'):
+        device = torch.device('cpu')
     model = Seq2SeqTransformer(
         len(checkpoint['src_vocab']),
         len(checkpoint['tgt_vocab']),
         d_model, nhead, num_layers, dim_ff, dropout
     ).to(device)
-    model.load_state_dict(checkpoint['model_state_dict'])
     model.eval()
+    if checkpoint.get('quantize'):
+        quantize_dynamic(model)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    if quantize and not checkpoint.get('quantize'):
+        quantize_dynamic(model)
     return model, checkpoint['src_vocab'], checkpoint['tgt_vocab']
 
 
-def load_tokenized_dataset(src_path, tgt_path, src_vocab, tgt_vocab):
+def load_tokenized_dataset(src_path, tgt_path, src_vocab, tgt_vocab, cache=None):
     """Load tokenized parallel data using the given vocabularies."""
+    if cache is None:
+        data, unk_src, unk_tgt = _tokenize(src_path, tgt_path, src_vocab, tgt_vocab)
+    else:
+        key = cache.key([src_path, tgt_path], kind='eval',
+                        src_vocab=src_vocab, tgt_vocab=tgt_vocab)
+        entry = cache.load(key)
+        if entry is None:
+            data, unk_src, unk_tgt = _tokenize(src_path, tgt_path, src_vocab, tgt_vocab)
+            cache.store(key, _flatten(data), {'unk_src': unk_src, 'unk_tgt': unk_tgt})
+        else:
+            arrays, meta = entry
+            data = _unflatten(arrays)
+            unk_src, unk_tgt = meta['unk_src'], meta['unk_tgt']
+
+    class SimpleDataset:
+        pass
+
+    dataset = SimpleDataset()
+    dataset.src_path = src_path
+    dataset.tgt_path = tgt_path
+    dataset.src_vocab = src_vocab
+    dataset.tgt_vocab = tgt_vocab
+    dataset.data = data
+    dataset.src_unk_count = unk_src
+    dataset.tgt_unk_count = unk_tgt
+    return dataset
+
+
+def _flatten(data):
+    arrays = {}
+    for side, seqs in (('src', [s for s, _ in data]), ('tgt', [t for _, t in data])):
+        arrays[side + '_ids'] = np.fromiter((i for seq in seqs for i in seq), dtype=np.int32)
+        arrays[side + '_offsets'] = np.cumsum([0] + [len(seq) for seq in seqs], dtype=np.int64)
+    return arrays
+
+
+def _unflatten(arrays):
+    seqs = {}
+    for side in ('src', 'tgt'):
+        ids = arrays[side + '_ids'].tolist()
+        offsets = arrays[side + '_offsets'].tolist()
+        seqs[side] = [ids[a:b] for a, b in zip(offsets, offsets[1:])]
+    return list(zip(seqs['src'], seqs['tgt']))
+
+
+def _tokenize(src_path, tgt_path, src_vocab, tgt_vocab):
     with open(src_path, 'r', encoding='utf-8') as f:
         src_lines = [l.strip().split() for l in f if l.strip()]
     with open(tgt_path, 'r', encoding='utf-8') as f:
@@ -42,63 +109,316 @@ def load_tokenized_dataset(src_path, tgt_path, src_vocab, tgt_vocab):
             tgt_ids.append(idx)
         tgt_ids.append(tgt_vocab.get('<eos>'))
         data.append((src_ids, tgt_ids))
+    return data, unk_src, unk_tgt
 
-    class SimpleDataset:
-        pass
-
-    dataset = SimpleDataset()
-    dataset.src_path = src_path
-    dataset.tgt_path = tgt_path
-    dataset.src_vocab = src_vocab
-    dataset.tgt_vocab = tgt_vocab
-    dataset.data = data
-    dataset.src_unk_count = unk_src
-    dataset.tgt_unk_count = unk_tgt
-    return dataset
 
-
-def greedy_decode(model, src, src_vocab, tgt_vocab, device, max_len=50):
+def greedy_decode(model, src, src_vocab, tgt_vocab, device, max_len=50, shortlist=None):
     src = torch.tensor([src], device=device)
     src_mask = None
     memory = model.encode(src, src_mask, src == 0)
-    ys = torch.tensor([[tgt_vocab['<bos>']]], device=device)
+    # cross-attention keys/values are computed once; each step only runs the new token
+    cache = model.init_decode_cache(memory, src == 0)
+    allowed = shortlist.select(src) if shortlist is not None else None
+    fc_out = model.output_layer(allowed)
+    ys = [tgt_vocab['<bos>']]
     for _ in range(max_len):
-        tgt_mask = generate_square_subsequent_mask(ys.size(1)).to(device)
-        out = model.decode(ys, memory, tgt_mask=tgt_mask,
-                           memory_padding_mask=src == 0,
-                           tgt_padding_mask=ys == 0)
-        prob = model.fc_out(out[:, -1])
+        last = torch.tensor([[ys[-1]]], device=device)
+        out = model.decode_step(last, cache, tgt_padding_mask=last == 0)
+        prob = fc_out(out[:, -1])
         next_word = prob.argmax(dim=-1).item()
-        ys = torch.cat([ys, torch.tensor([[next_word]], device=device)], dim=1)
+        if allowed is not None:
+            next_word = allowed[next_word].item()
+        ys.append(next_word)
         if next_word == tgt_vocab['<eos>']:
             break
-    return ys.squeeze(0).tolist()[1:]
-
-
-def compute_accuracy(model, dataset, device):
-    correct = 0
-    total = 0
-    svocab = {y : x for x, y in dataset.src_vocab.items()}
-    
-    rvocab = {y : x for x, y in dataset.tgt_vocab.items()}
-    for src_ids, tgt_ids in tqdm.tqdm(dataset.data):
-        pred = greedy_decode(model, src_ids, dataset.src_vocab, dataset.tgt_vocab, device, max_len=len(tgt_ids)+2)
-        # remove eos if present
-        if pred and pred[-1] == dataset.tgt_vocab['<eos>']:
+    return ys[1:]
+
+
+def batched_greedy_decode(model, src_batch, tgt_vocab, device, max_lens, shortlist=None):
+    """Greedy-decode several sources at once.
+
+    ``src_batch`` is a list of source id lists and ``max_lens`` gives the
+    step limit of each row. Rows stop growing once they emit ``<eos>`` or
+    reach their limit, and decoding ends when every row has stopped. The
+    returned lists follow the ``greedy_decode`` convention. With a
+    ``Shortlist`` the logits only cover the target tokens it selects for the
+    batch.
+    """
+    src = torch.zeros(len(src_batch), max(len(s) for s in src_batch),
+                      dtype=torch.long, device=device)
+    for row, ids in enumerate(src_batch):
+        src[row, :len(ids)] = torch.tensor(ids, device=device)
+    src_padding_mask = src == 0
+    memory = model.encode(src, None, src_padding_mask)
+    cache = model.init_decode_cache(memory, src_padding_mask)
+    allowed = shortlist.select(src) if shortlist is not None else None
+    fc_out = model.output_layer(allowed)
+    eos = tgt_vocab['<eos>']
+    limits = torch.tensor(max_lens, device=device)
+    finished = limits <= 0
+    last = torch.full((len(src_batch), 1), tgt_vocab['<bos>'], dtype=torch.long, device=device)
+    steps = []
+    while not finished.all():
+        out = model.decode_step(last, cache, tgt_padding_mask=last == 0)
+        next_word = fc_out(out[:, -1]).argmax(dim=-1)
+        if allowed is not None:
+            next_word = allowed[next_word]
+        # finished rows keep decoding padding so the batch stays rectangular
+        next_word = next_word.masked_fill(finished, tgt_vocab['<pad>'])
+        steps.append(next_word)
+        finished = finished | (next_word == eos) | (limits <= len(steps))
+        last = next_word.unsqueeze(1)
+    if not steps:
+        return [[] for _ in src_batch]
+    preds = []
+    for row, ids in enumerate(torch.stack(steps, dim=1).tolist()):
+        ids = ids[:max_lens[row]]
+        if eos in ids:
+            ids = ids[:ids.index(eos) + 1]
+        preds.append(ids)
+    return preds
+
+
+def beam_search_decode(model, src_batch, tgt_vocab, device, max_lens, beam_size=5, alpha=1.0,
+                       shortlist=None):
+    """Beam search over several sources at once.
+
+    The beams of all sentences form one (sentences * beam_size) batch. The
+    encoder runs once per sentence and the cross-attention keys/values are
+    shared by its beams. Hypotheses that emit ``<eos>`` leave the beam; a
+    sentence is done once it has ``beam_size`` of them or reaches its length
+    limit, and its rows are then dropped from the batch. Finished scores are
+    divided by ``length ** alpha``. Returns the best hypothesis of each
+    sentence following the ``greedy_decode`` convention. With a ``Shortlist``
+    the scores are normalized over the target tokens it selects.
+    """
+    k = beam_size
+    src = torch.zeros(len(src_batch), max(len(s) for s in src_batch),
+                      dtype=torch.long, device=device)
+    for row, ids in enumerate(src_batch):
+        src[row, :len(ids)] = torch.tensor(ids, device=device)
+    src_padding_mask = src == 0
+    memory = model.encode(src, None, src_padding_mask)
+    cache = model.init_decode_cache(memory, src_padding_mask)
+    allowed = shortlist.select(src) if shortlist is not None else None
+    fc_out = model.output_layer(allowed)
+    model.reorder_decode_cache(cache, torch.arange(len(src_batch), device=device).repeat_interleave(k))
+
+    eos = tgt_vocab['<eos>']
+    active = [i for i in range(len(src_batch)) if max_lens[i] > 0]
+    finished = [[] for _ in src_batch]
+    if len(active) < len(src_batch):
+        rows = torch.tensor([i * k + b for i in active for b in range(k)], dtype=torch.long, device=device)
+        model.reorder_decode_cache(cache, rows)
+    # only the first beam of each sentence is live at the start
+    scores = torch.full((len(active), k), float('-inf'), device=device)
+    scores[:, 0] = 0.0
+    hyps = torch.full((len(active) * k, 1), tgt_vocab['<bos>'], dtype=torch.long, device=device)
+    step = 0
+    while active:
+        step += 1
+        last = hyps[:, -1:]
+        out = model.decode_step(last, cache, tgt_padding_mask=last == 0)
+        log_probs = torch.log_softmax(fc_out(out[:, -1]), dim=-1)
+        vocab_size = log_probs.size(-1)
+        candidates = (scores.view(-1, 1) + log_probs).view(len(active), k * vocab_size)
+        # 2k candidates always leave k that do not end in <eos>; only <eos>
+        # among the best k finishes a hypothesis
+        top_scores, top_idx = candidates.topk(min(2 * k, candidates.size(1)), dim=1)
+        origin = top_idx // vocab_size
+        words = top_idx % vocab_size
+        if allowed is not None:
+            words = allowed[words]
+        is_eos = (words == eos) & torch.isfinite(top_scores)
+        is_eos[:, k:] = False
+        if is_eos.any():
+            origin_list, score_list = origin.tolist(), top_scores.tolist()
+            for r, c in is_eos.nonzero().tolist():
+                hyp = hyps[r * k + origin_list[r][c], 1:].tolist() + [eos]
+                finished[active[r]].append((score_list[r][c] / len(hyp) ** alpha, hyp))
+
+        alive_scores, pos = top_scores.masked_fill(words == eos, float('-inf')).topk(k, dim=1)
+        rows = (torch.arange(len(active), device=device).unsqueeze(1) * k + origin.gather(1, pos)).view(-1)
+        hyps = torch.cat([hyps.index_select(0, rows), words.gather(1, pos).view(-1, 1)], dim=1)
+
+        keep = []
+        for r, sent in enumerate(active):
+            if len(finished[sent]) >= k or step >= max_lens[sent]:
+                if not finished[sent]:
+                    for b in range(k):
+                        if torch.isfinite(alive_scores[r, b]):
+                            hyp = hyps[r * k + b, 1:].tolist()
+                            finished[sent].append((alive_scores[r, b].item() / len(hyp) ** alpha, hyp))
+            else:
+                keep.append(r)
+        if len(keep) < len(active):
+            keep_rows = torch.tensor([r * k + b for r in keep for b in range(k)],
+                                     dtype=torch.long, device=device)
+            rows = rows.index_select(0, keep_rows)
+            hyps = hyps.index_select(0, keep_rows)
+            alive_scores = alive_scores[keep]
+            active = [active[r] for r in keep]
+        model.reorder_decode_cache(cache, rows)
+        scores = alive_scores
+    return [max(f, key=lambda h: h[0])[1] if f else [] for f in finished]
+
+
+class PredictionWriter:
+    """Write decoded examples as JSON lines from a background thread.
+
+    ``write`` queues a batch of ``(index, src_ids, pred_ids, tgt_ids)`` and
+    returns at once; the thread turns the ids into text and writes one
+    ``{"line", "src", "pred", "ref"}`` record per example (``line`` counts
+    from 1). At most ``max_pending`` batches wait in the queue, so a slow
+    disk holds decoding back instead of filling memory. Errors raised by the
+    thread are re-raised by the next ``write`` or ``close``.
+    """
+    def __init__(self, path, src_vocab, tgt_vocab, max_pending=64):
+        self.src_itos = {i: t for t, i in src_vocab.items()}
+        self.tgt_itos = {i: t for t, i in tgt_vocab.items()}
+        self.skip = {tgt_vocab[t] for t in ('<bos>', '<eos>', '<pad>') if t in tgt_vocab}
+        self._file = open(path, 'w', encoding='utf-8')
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _text(self, itos, ids):
+        return ' '.join(itos[i] for i in ids if i not in self.skip)
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._file.write(''.join(
+                    json.dumps({'line': i + 1,
+                                'src': ' '.join(self.src_itos[x] for x in src_ids),
+                                'pred': self._text(self.tgt_itos, pred),
+                                'ref': self._text(self.tgt_itos, tgt_ids)},
+                               ensure_ascii=False) + '\n'
+                    for i, src_ids, pred, tgt_ids in batch))
+            except Exception as e:
+                self._error = e
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, batch):
+        self._raise()
+        self._queue.put(batch)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        self._raise()
+
+
+def decode_dataset(model, dataset, device, batch_size=1, beam_size=1, alpha=1.0,
+                   writer=None, progress=False, shortlist=None):
+    """Decode every example of ``dataset`` and return predictions in order.
+
+    Uses greedy decoding, or beam search when ``beam_size`` > 1. Examples
+    are grouped by source length so batches carry little padding. Each
+    decoded batch is handed to ``writer`` (a ``PredictionWriter``), so the
+    records come in decoding order; ``progress`` shows a progress bar.
+    ``shortlist`` restricts each batch's output layer (see ``Shortlist``).
+    """
+    preds = [None] * len(dataset.data)
+    order = sorted(range(len(dataset.data)), key=lambda i: len(dataset.data[i][0]))
+    for start in tqdm.tqdm(range(0, len(order), batch_size), disable=not progress):
+        idx = order[start:start + batch_size]
+        if beam_size > 1:
+            batch = beam_search_decode(
+                model,
+                [dataset.data[i][0] for i in idx],
+                dataset.tgt_vocab,
+                device,
+                [len(dataset.data[i][1]) + 2 for i in idx],
+                beam_size,
+                alpha,
+                shortlist,
+            )
+        elif len(idx) == 1:
+            src_ids, tgt_ids = dataset.data[idx[0]]
+            batch = [greedy_decode(model, src_ids, dataset.src_vocab, dataset.tgt_vocab,
+                                   device, max_len=len(tgt_ids)+2, shortlist=shortlist)]
+        else:
+            batch = batched_greedy_decode(
+                model,
+                [dataset.data[i][0] for i in idx],
+                dataset.tgt_vocab,
+                device,
+                [len(dataset.data[i][1]) + 2 for i in idx],
+                shortlist,
+            )
+        for i, pred in zip(idx, batch):
+            preds[i] = pred
+        if writer is not None:
+            writer.write([(i, dataset.data[i][0], pred, dataset.data[i][1])
+                          for i, pred in zip(idx, batch)])
+    return preds
+
+
+def score_predictions(dataset, preds, bucket_width=5, mismatches=None):
+    """Return the ``Metrics`` of ``preds`` against the targets of ``dataset``.
+
+    ``<bos>`` and ``<eos>`` are not scored. Mismatched examples are passed,
+    as text, to the ``mismatches`` writer when one is given.
+    """
+    eos = dataset.tgt_vocab['<eos>']
+    metrics = Metrics(bucket_width)
+    if mismatches is not None:
+        svocab = {i: t for t, i in dataset.src_vocab.items()}
+        rvocab = {i: t for t, i in dataset.tgt_vocab.items()}
+    for line, ((src_ids, tgt_ids), pred) in enumerate(zip(dataset.data, preds), 1):
+        if pred and pred[-1] == eos:
             pred = pred[:-1]
-        
-        print(f"Input : {[svocab[x] for x in src_ids]}")
-        
-        print(f"Pred : {[rvocab[x] for x in pred]}")
-        target = tgt_ids[1:]  # skip bos
-        print(f"Target : {[rvocab[x] for x in target]}")
-        
-        length = min(len(pred), len(target))
-        for p, t in zip(pred[:length], target[:length]):
-            if p == t:
-                correct += 1
-        total += len(target)
-    return correct / total if total > 0 else 0.0
+        target = tgt_ids[1:-1]  # skip bos and eos
+        if not metrics.add(pred, target) and mismatches is not None:
+            mismatches.write(line, ' '.join(svocab[x] for x in src_ids),
+                             ' '.join(rvocab[x] for x in target),
+                             ' '.join(rvocab[x] for x in pred))
+    return metrics
+
+
+def legacy_accuracy(metrics):
+    """The ``Accuracy:`` figure of earlier releases, computed from ``metrics``.
+
+    Each target's ``<eos>`` counts towards the total but is never matched,
+    since predictions are scored without it, so the value is a little below
+    ``metrics.token_accuracy``. It is kept so results stay comparable.
+    """
+    total = metrics.ref_tokens + metrics.examples
+    return metrics.correct_tokens / total if total else 0.0
+
+
+def token_accuracy(dataset, preds):
+    """Share of target tokens predicted at the right position (``legacy_accuracy``)."""
+    return legacy_accuracy(score_predictions(dataset, preds))
+
+
+@torch.no_grad()
+def compute_metrics(model, dataset, device, batch_size=1, beam_size=1, alpha=1.0,
+                    bucket_width=5, mismatches=None, writer=None, progress=False,
+                    shortlist=None):
+    """Decode ``dataset`` and return the ``Metrics`` of the predictions."""
+    preds = decode_dataset(model, dataset, device, batch_size, beam_size, alpha,
+                           writer, progress, shortlist)
+    return score_predictions(dataset, preds, bucket_width, mismatches)
+
+
+def compute_accuracy(model, dataset, device, batch_size=1, beam_size=1, alpha=1.0,
+                     shortlist=None):
+    """Decode ``dataset`` and return its token accuracy (``legacy_accuracy``) as a float."""
+    return legacy_accuracy(compute_metrics(model, dataset, device, batch_size, beam_size,
+                                           alpha, shortlist=shortlist))
 
 
 def main():
@@ -111,18 +431,71 @@ def main():
     parser.add_argument('--num-layers', type=int, default=2)
     parser.add_argument('--dim-ff', type=int, default=512)
     parser.add_argument('--dropout', type=float, default=0.1)
+    parser.add_argument('--eval-batch-size', type=int, default=1,
+                        help='Number of sentences decoded together')
+    parser.add_argument('--beam-size', type=int, default=1,
+                        help='Beam width; 1 means greedy decoding')
+    parser.add_argument('--beam-alpha', type=float, default=1.0,
+                        help='Length normalization exponent for beam scores')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory caching tokenized data across runs')
+    parser.add_argument('--cache-size-mb', type=float, default=1024,
+                        help='Size limit of the cache directory')
+    parser.add_argument('--quantize', choices=['int8'], default=None,
+                        help='Apply dynamic int8 quantization to the linear layers (CPU)')
+    parser.add_argument('--save-quantized', type=str, default=None,
+                        help='Save the quantized model to this path (implies --quantize int8)')
+    parser.add_argument('--bucket-width', type=int, default=5,
+                        help='Target length range of each accuracy bucket')
+    parser.add_argument('--mismatches', type=str, default=None,
+                        help='Write mismatched examples to this file as JSON lines')
+    parser.add_argument('--max-mismatches', type=int, default=1000,
+                        help='Most mismatches written to --mismatches')
+    parser.add_argument('--dump-predictions', type=str, default=None,
+                        help='Write every prediction to this file as JSON lines')
+    parser.add_argument('--progress', action='store_true',
+                        help='Show a decoding progress bar')
+    parser.add_argument('--shortlist', type=str, default=None,
+                        help='Project onto the target tokens of this source-conditioned '
+                             'shortlist (see src.seq2seq.shortlist)')
     args = parser.parse_args()
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if args.save_quantized and not args.quantize:
+        # there is nothing to save without quantizing first
+        args.quantize = 'int8'
+    if args.quantize:
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model, src_vocab, tgt_vocab = load_model(
-        args.model, device, args.d_model, args.nhead, args.num_layers, args.dim_ff, args.dropout
+        args.model, device, args.d_model, args.nhead, args.num_layers, args.dim_ff, args.dropout,
+        args.quantize
     )
-    dataset = load_tokenized_dataset(args.src, args.tgt, src_vocab, tgt_vocab)
+    # quantized checkpoints are always loaded on the CPU
+    device = next(model.parameters()).device
+    if args.save_quantized:
+        save_quantized(model, load_checkpoint(args.model), args.save_quantized)
+    cache = build_cache(args.cache_dir, args.cache_size_mb)
+    dataset = load_tokenized_dataset(args.src, args.tgt, src_vocab, tgt_vocab, cache)
     if dataset.src_unk_count or dataset.tgt_unk_count:
         print(f"<unk> tokens in evaluation data - src: {dataset.src_unk_count}, tgt: {dataset.tgt_unk_count}")
     else:
         print("No <unk> tokens in evaluation data")
-    acc = compute_accuracy(model, dataset, device)
-    print(f'Accuracy: {acc*100:.2f}%')
+    mismatches = MismatchWriter(args.mismatches, args.max_mismatches) if args.mismatches else None
+    shortlist = Shortlist.load(args.shortlist) if args.shortlist else None
+    writer = None
+    if args.dump_predictions:
+        writer = PredictionWriter(args.dump_predictions, src_vocab, tgt_vocab)
+    try:
+        metrics = compute_metrics(model, dataset, device, args.eval_batch_size,
+                                  args.beam_size, args.beam_alpha, args.bucket_width,
+                                  mismatches, writer, args.progress, shortlist)
+    finally:
+        if mismatches is not None:
+            mismatches.close()
+        if writer is not None:
+            writer.close()
+    print(metrics.report())
+    print(f'Accuracy: {legacy_accuracy(metrics)*100:.2f}%')
 
 
 if __name__ == '__main__':
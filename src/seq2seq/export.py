@@ -0,0 +1,255 @@
+import argparse
+import json
+import math
+import os
+import time
+import torch
+import torch.nn as nn
+from .data import load_vocab, save_vocab
+from .evaluate import load_model, batched_greedy_decode
+from ..model import _encoder_layer_step, attention_projection
+from .model import _decoder_layer_step
+
+
+class EncoderGraph(nn.Module):
+    """Encoder plus the cross-attention projections of every decoder layer.
+
+    ``forward(src)`` returns ``(mem_k, mem_v, memory_keep)``: keys and values
+    stacked to (layers, batch, heads, src_len, head_dim) and a boolean
+    (batch, 1, 1, src_len) mask that is ``True`` for real source tokens. The
+    layers are run through the same step functions as ``decode_step``, so
+    the graph has no data-dependent control flow and can be traced.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, src):
+        m = self.model
+        memory_keep = (src != 0).view(src.size(0), 1, 1, src.size(1))
+        x = m.pos_enc(m.src_emb(src) * math.sqrt(m.d_model))
+        for layer in m.transformer.encoder.layers:
+            x = _encoder_layer_step(layer, x, {'k': None, 'v': None}, memory_keep)
+        if m.transformer.encoder.norm is not None:
+            x = m.transformer.encoder.norm(x)
+        layers = m.transformer.decoder.layers
+        mem_k = torch.stack([attention_projection(l.multihead_attn, x, 1) for l in layers])
+        mem_v = torch.stack([attention_projection(l.multihead_attn, x, 2) for l in layers])
+        return mem_k, mem_v, memory_keep
+
+
+class DecoderStepGraph(nn.Module):
+    """One decoding step with the cache passed in and out as tensors.
+
+    ``forward(tokens, pos, self_k, self_v, mem_k, mem_v, memory_keep)`` takes
+    the (batch, 1) newest tokens, their position as a one-element long
+    tensor, the self-attention cache stacked to (layers, batch, heads,
+    past_len, head_dim) and the outputs of ``EncoderGraph``. It returns the
+    (batch, vocab) logits and the cache grown by one position.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tokens, pos, self_k, self_v, mem_k, mem_v, memory_keep):
+        m = self.model
+        x = m.tgt_emb(tokens) * math.sqrt(m.d_model) + m.pos_enc.pe.index_select(1, pos)
+        new_k, new_v = [], []
+        for i, layer in enumerate(m.transformer.decoder.layers):
+            cache = {'self_k': self_k[i], 'self_v': self_v[i], 'mem_k': mem_k[i], 'mem_v': mem_v[i]}
+            x = _decoder_layer_step(layer, x, cache, None, memory_keep)
+            new_k.append(cache['self_k'])
+            new_v.append(cache['self_v'])
+        if m.transformer.decoder.norm is not None:
+            x = m.transformer.decoder.norm(x)
+        return m.fc_out(x[:, -1]), torch.stack(new_k), torch.stack(new_v)
+
+
+def _example_inputs(model, batch=2, src_len=5, past=3):
+    layers = len(model.transformer.decoder.layers)
+    nhead = model.transformer.decoder.layers[0].self_attn.num_heads
+    head_dim = model.d_model // nhead
+    src = torch.randint(4, model.src_emb.num_embeddings, (batch, src_len))
+    src[0, -1] = 0
+    cache = torch.zeros(layers, batch, nhead, past, head_dim)
+    tokens = torch.randint(4, model.tgt_emb.num_embeddings, (batch, 1))
+    return src, (tokens, torch.tensor([past]), cache, cache)
+
+
+def export_torchscript(model, output_dir):
+    """Trace and freeze both graphs into ``encoder.pt`` and ``decoder_step.pt``."""
+    src, (tokens, pos, self_k, self_v) = _example_inputs(model)
+    with torch.no_grad():
+        encoder = torch.jit.trace(EncoderGraph(model).eval(), (src,))
+        mem_k, mem_v, memory_keep = encoder(src)
+        step = torch.jit.trace(DecoderStepGraph(model).eval(),
+                               (tokens, pos, self_k, self_v, mem_k, mem_v, memory_keep))
+    torch.jit.freeze(encoder).save(os.path.join(output_dir, 'encoder.pt'))
+    torch.jit.freeze(step).save(os.path.join(output_dir, 'decoder_step.pt'))
+
+
+def export_onnx(model, output_dir):
+    """Export both graphs to ONNX with dynamic batch, source and cache lengths."""
+    try:
+        import onnx  # noqa: F401  (needed by torch.onnx.export)
+    except ImportError:
+        raise SystemExit('ONNX export needs the onnx package: pip install onnx onnxruntime')
+    src, (tokens, pos, self_k, self_v) = _example_inputs(model)
+    with torch.no_grad():
+        mem_k, mem_v, memory_keep = EncoderGraph(model).eval()(src)
+        torch.onnx.export(
+            EncoderGraph(model).eval(), (src,), os.path.join(output_dir, 'encoder.onnx'),
+            input_names=['src'], output_names=['mem_k', 'mem_v', 'memory_keep'],
+            dynamic_axes={'src': {0: 'batch', 1: 'src_len'},
+                          'mem_k': {1: 'batch', 3: 'src_len'},
+                          'mem_v': {1: 'batch', 3: 'src_len'},
+                          'memory_keep': {0: 'batch', 3: 'src_len'}},
+            dynamo=False)
+        torch.onnx.export(
+            DecoderStepGraph(model).eval(),
+            (tokens, pos, self_k, self_v, mem_k, mem_v, memory_keep),
+            os.path.join(output_dir, 'decoder_step.onnx'),
+            input_names=['tokens', 'pos', 'self_k', 'self_v', 'mem_k', 'mem_v', 'memory_keep'],
+            output_names=['logits', 'new_self_k', 'new_self_v'],
+            dynamic_axes={'tokens': {0: 'batch'},
+                          'self_k': {1: 'batch', 3: 'past_len'},
+                          'self_v': {1: 'batch', 3: 'past_len'},
+                          'mem_k': {1: 'batch', 3: 'src_len'},
+                          'mem_v': {1: 'batch', 3: 'src_len'},
+                          'memory_keep': {0: 'batch', 3: 'src_len'},
+                          'logits': {0: 'batch'},
+                          'new_self_k': {1: 'batch', 3: 'total_len'},
+                          'new_self_v': {1: 'batch', 3: 'total_len'}},
+            dynamo=False)
+
+
+class _OnnxGraph:
+    """Call an onnxruntime session like a TorchScript module."""
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        feeds = {name: t.numpy() for name, t in zip(self.names, inputs)}
+        return tuple(torch.from_numpy(o) for o in self.session.run(None, feeds))
+
+
+class ExportedTranslator:
+    """Greedy decoding loop over exported graphs, without the Python model.
+
+    ``path`` is the directory written by ``export``; the TorchScript graphs
+    are used unless ``backend`` is ``'onnx'``.
+    """
+    def __init__(self, path, backend='torchscript'):
+        if backend == 'onnx':
+            self.encoder = _OnnxGraph(os.path.join(path, 'encoder.onnx'))
+            self.step = _OnnxGraph(os.path.join(path, 'decoder_step.onnx'))
+        else:
+            self.encoder = torch.jit.load(os.path.join(path, 'encoder.pt'))
+            self.step = torch.jit.load(os.path.join(path, 'decoder_step.pt'))
+        self.src_vocab, self.tgt_vocab = load_vocab(os.path.join(path, 'vocab.json'))
+        with open(os.path.join(path, 'config.json'), 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+
+    @torch.no_grad()
+    def decode(self, src_batch, max_lens):
+        """Same inputs and outputs as ``batched_greedy_decode``."""
+        src = torch.zeros(len(src_batch), max(len(s) for s in src_batch), dtype=torch.long)
+        for row, ids in enumerate(src_batch):
+            src[row, :len(ids)] = torch.tensor(ids)
+        mem_k, mem_v, memory_keep = self.encoder(src)
+        layers, nhead, head_dim = (self.config[k] for k in ('layers', 'nhead', 'head_dim'))
+        self_k = self_v = torch.zeros(layers, len(src_batch), nhead, 0, head_dim)
+        eos = self.tgt_vocab['<eos>']
+        limits = torch.tensor(max_lens)
+        finished = limits <= 0
+        last = torch.full((len(src_batch), 1), self.tgt_vocab['<bos>'], dtype=torch.long)
+        steps = []
+        while not finished.all():
+            pos = torch.tensor([len(steps)])
+            logits, self_k, self_v = self.step(last, pos, self_k, self_v, mem_k, mem_v, memory_keep)
+            next_word = logits.argmax(dim=-1).masked_fill(finished, self.tgt_vocab['<pad>'])
+            steps.append(next_word)
+            finished = finished | (next_word == eos) | (limits <= len(steps))
+            last = next_word.unsqueeze(1)
+        if not steps:
+            return [[] for _ in src_batch]
+        preds = []
+        for row, ids in enumerate(torch.stack(steps, dim=1).tolist()):
+            ids = ids[:max_lens[row]]
+            if eos in ids:
+                ids = ids[:ids.index(eos) + 1]
+            preds.append(ids)
+        return preds
+
+
+def export(model, src_vocab, tgt_vocab, output_dir, fmt='torchscript'):
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.cpu().eval()
+    if fmt == 'onnx':
+        export_onnx(model, output_dir)
+    else:
+        export_torchscript(model, output_dir)
+    save_vocab(os.path.join(output_dir, 'vocab.json'), src_vocab, tgt_vocab)
+    layer = model.transformer.decoder.layers[0]
+    config = {'layers': len(model.transformer.decoder.layers),
+              'nhead': layer.self_attn.num_heads,
+              'head_dim': model.d_model // layer.self_attn.num_heads}
+    with open(os.path.join(output_dir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export a seq2seq model as an encoder graph and a single-step decoder graph'
+    )
+    parser.add_argument('--model', required=True, help='Path to trained model')
+    parser.add_argument('--output-dir', required=True, help='Directory for the exported graphs')
+    parser.add_argument('--format', choices=['torchscript', 'onnx'], default='torchscript')
+    parser.add_argument('--d-model', type=int, default=128)
+    parser.add_argument('--nhead', type=int, default=4)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--dim-ff', type=int, default=512)
+    parser.add_argument('--dropout', type=float, default=0.1)
+    parser.add_argument('--check', type=str, default=None,
+                        help='Source file to compare exported and eager outputs and latency on')
+    parser.add_argument('--eval-batch-size', type=int, default=1,
+                        help='Number of sentences decoded together when checking')
+    parser.add_argument('--max-len', type=int, default=100)
+    args = parser.parse_args()
+    device = torch.device('cpu')
+    model, src_vocab, tgt_vocab = load_model(
+        args.model, device, args.d_model, args.nhead, args.num_layers, args.dim_ff, args.dropout
+    )
+    export(model, src_vocab, tgt_vocab, args.output_dir, args.format)
+    print('Exported to', args.output_dir)
+    if not args.check:
+        return
+
+    translator = ExportedTranslator(args.output_dir, args.format)
+    with open(args.check, 'r', encoding='utf-8') as f:
+        sources = [[src_vocab.get(tok, src_vocab['<unk>']) for tok in line.split()]
+                   for line in f if line.strip()]
+    batches = [sources[i:i + args.eval_batch_size]
+               for i in range(0, len(sources), args.eval_batch_size)]
+    timings = {}
+    outputs = {}
+    decoders = {
+        'eager': lambda b: batched_greedy_decode(model, b, tgt_vocab, device, [args.max_len] * len(b)),
+        args.format: lambda b: translator.decode(b, [args.max_len] * len(b)),
+    }
+    for name, decode in decoders.items():
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs[name] = [pred for batch in batches for pred in decode(batch)]
+        timings[name] = time.perf_counter() - start
+    tokens = sum(len(pred) for pred in outputs['eager'])
+    same = sum(a == b for a, b in zip(outputs['eager'], outputs[args.format]))
+    print(f"Identical outputs: {same}/{len(sources)}")
+    for name, elapsed in timings.items():
+        print(f"{name:12} {1000 * elapsed / max(tokens, 1):.3f} ms/token")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,18 @@
 import math
 import torch
 import torch.nn as nn
-from ..model import PositionalEncoding, generate_square_subsequent_mask
+import torch.nn.functional as F
+from ..model import (
+    PositionalEncoding,
+    generate_square_subsequent_mask,
+    causal_mask,
+    pad_packed,
+    split_heads,
+    attention_projection,
+    self_attention_projection,
+    cached_attention,
+    step_attention_mask,
+)
 
 class Seq2SeqTransformer(nn.Module):
     def __init__(self, src_vocab_size, tgt_vocab_size,
@@ -24,17 +35,22 @@ class Seq2SeqTransformer(nn.Module):
         self.fc_out = nn.Linear(d_model, tgt_vocab_size)
 
     def forward(self, src, tgt, src_mask=None, tgt_mask=None,
-                src_padding_mask=None, tgt_padding_mask=None):
-        src = self.pos_enc(self.src_emb(src) * math.sqrt(self.d_model))
-        tgt = self.pos_enc(self.tgt_emb(tgt) * math.sqrt(self.d_model))
-        memory = self.transformer.encoder(src, mask=src_mask,
-                                          src_key_padding_mask=src_padding_mask)
-        out = self.transformer.decoder(
-            tgt, memory,
-            tgt_mask=tgt_mask,
-            memory_key_padding_mask=src_padding_mask,
-            tgt_key_padding_mask=tgt_padding_mask,
-        )
+                src_padding_mask=None, tgt_padding_mask=None,
+                tgt_is_causal=False, packed=False):
+        """Return target logits for teacher-forced ``tgt``.
+
+        ``tgt_is_causal=True`` lets the decoder self-attention use the fused
+        causal kernel (``tgt_mask`` may then be omitted). With ``packed=True``
+        the decoder only computes the positions where ``tgt_padding_mask`` is
+        ``False`` and the logits come back as (tokens, vocab), in the order of
+        ``out[~tgt_padding_mask]``; see ``decode_packed``.
+        """
+        memory = self.encode(src, src_mask, src_padding_mask)
+        if packed:
+            out = self.decode_packed(tgt, memory, tgt_padding_mask, src_padding_mask)
+        else:
+            out = self.decode(tgt, memory, tgt_mask, tgt_padding_mask, src_padding_mask,
+                              tgt_is_causal)
         return self.fc_out(out)
 
     def encode(self, src, src_mask=None, src_padding_mask=None):
@@ -43,11 +59,144 @@ class Seq2SeqTransformer(nn.Module):
                                         src_key_padding_mask=src_padding_mask)
 
     def decode(self, tgt, memory, tgt_mask=None, tgt_padding_mask=None,
-               memory_padding_mask=None):
+               memory_padding_mask=None, tgt_is_causal=False):
+        if tgt_is_causal and tgt_mask is None:
+            tgt_mask = causal_mask(tgt.size(1), tgt.device)
         tgt = self.pos_enc(self.tgt_emb(tgt) * math.sqrt(self.d_model))
         return self.transformer.decoder(
             tgt, memory,
             tgt_mask=tgt_mask,
             memory_key_padding_mask=memory_padding_mask,
             tgt_key_padding_mask=tgt_padding_mask,
+            tgt_is_causal=tgt_is_causal,
         )
+
+    def decode_packed(self, tgt, memory, tgt_padding_mask, memory_padding_mask=None):
+        """Causal teacher-forced decoding that skips the target padding.
+
+        Returns (tokens, d_model) for the positions where ``tgt_padding_mask``
+        is ``False``. Embeddings, projections, feed-forward blocks and norms
+        only run on those tokens; attention scatters them back into the padded
+        layout. Padding must follow the tokens of each row, as ``collate_fn``
+        pads: then no real token attends to padding and self-attention can use
+        the fused causal kernel without a mask.
+        """
+        keep = ~tgt_padding_mask
+        x = self.pos_enc(self.tgt_emb(tgt) * math.sqrt(self.d_model))[keep]
+        memory_mask = None
+        if memory_padding_mask is not None and memory_padding_mask.any():
+            memory_mask = ~memory_padding_mask.view(memory.size(0), 1, 1, -1)
+        for layer in self.transformer.decoder.layers:
+            x = _decoder_layer_packed(layer, x, keep, memory, memory_mask)
+        if self.transformer.decoder.norm is not None:
+            x = self.transformer.decoder.norm(x)
+        return x
+
+    def init_decode_cache(self, memory, memory_padding_mask=None):
+        """Prepare a cache for ``decode_step`` from the encoder ``memory``.
+
+        Cross-attention keys and values only depend on ``memory`` so they
+        are projected once here instead of at every decoding step.
+        """
+        layers = []
+        for layer in self.transformer.decoder.layers:
+            layers.append({
+                'self_k': None,
+                'self_v': None,
+                'mem_k': attention_projection(layer.multihead_attn, memory, 1),
+                'mem_v': attention_projection(layer.multihead_attn, memory, 2),
+            })
+        memory_mask = None
+        if memory_padding_mask is not None and memory_padding_mask.any():
+            memory_mask = ~memory_padding_mask.view(memory.size(0), 1, 1, -1)
+        return {'pos': 0, 'layers': layers,
+                'memory_mask': memory_mask, 'tgt_padding_mask': None}
+
+    def decode_step(self, tgt, cache, tgt_padding_mask=None):
+        """Decode the new tokens ``tgt`` given everything already in ``cache``.
+
+        Equivalent to the last ``tgt.size(1)`` positions of ``decode`` on the
+        full prefix, but each decoder layer only processes the new tokens.
+        ``cache`` is updated in place with their self-attention keys/values.
+        """
+        past = cache['pos']
+        x = self.pos_enc(self.tgt_emb(tgt) * math.sqrt(self.d_model), offset=past)
+        if tgt_padding_mask is not None:
+            if cache['tgt_padding_mask'] is None:
+                cache['tgt_padding_mask'] = torch.zeros(
+                    tgt.size(0), past, dtype=torch.bool, device=tgt.device)
+            cache['tgt_padding_mask'] = torch.cat(
+                [cache['tgt_padding_mask'], tgt_padding_mask], dim=1)
+        elif cache['tgt_padding_mask'] is not None:
+            cache['tgt_padding_mask'] = torch.cat(
+                [cache['tgt_padding_mask'], torch.zeros_like(tgt, dtype=torch.bool)], dim=1)
+        self_mask = step_attention_mask(past, tgt.size(1), cache['tgt_padding_mask'], tgt.device)
+        for layer, layer_cache in zip(self.transformer.decoder.layers, cache['layers']):
+            x = _decoder_layer_step(layer, x, layer_cache, self_mask, cache['memory_mask'])
+        cache['pos'] = past + tgt.size(1)
+        if self.transformer.decoder.norm is not None:
+            x = self.transformer.decoder.norm(x)
+        return x
+
+    def output_layer(self, ids=None):
+        """Return ``fc_out``, or a projection onto the target ids ``ids`` only.
+
+        The rows of ``ids`` are gathered once, so a decoder that keeps the same
+        shortlist for every step pays for the gather once. The logits of the
+        restricted projection are indexed like ``ids``. A dynamically
+        quantized ``fc_out`` is dequantized for the gather.
+        """
+        if ids is None:
+            return self.fc_out
+        weight, bias = self.fc_out.weight, self.fc_out.bias
+        if callable(weight):
+            weight, bias = weight().dequantize(), bias()
+        weight, bias = weight.index_select(0, ids), bias.index_select(0, ids)
+        return lambda x: F.linear(x, weight, bias)
+
+    @staticmethod
+    def reorder_decode_cache(cache, indices):
+        """Select (and possibly repeat) batch rows of ``cache`` in place.
+
+        Used by beam search to expand the cache to one row per beam and to
+        follow the beams that survive each step.
+        """
+        for layer_cache in cache['layers']:
+            for name, value in layer_cache.items():
+                if value is not None:
+                    layer_cache[name] = value.index_select(0, indices)
+        for name in ('memory_mask', 'tgt_padding_mask'):
+            if cache[name] is not None:
+                cache[name] = cache[name].index_select(0, indices)
+
+
+def _decoder_layer_step(layer, x, cache, self_mask, memory_mask):
+    """Run one post-norm ``nn.TransformerDecoderLayer`` on new positions only."""
+    q, k, v = self_attention_projection(layer.self_attn, x)
+    if cache['self_k'] is not None:
+        k = torch.cat([cache['self_k'], k], dim=2)
+        v = torch.cat([cache['self_v'], v], dim=2)
+    cache['self_k'], cache['self_v'] = k, v
+    x = layer.norm1(x + layer.dropout1(cached_attention(layer.self_attn, q, k, v, self_mask)))
+    q = attention_projection(layer.multihead_attn, x, 0)
+    x = layer.norm2(x + layer.dropout2(cached_attention(
+        layer.multihead_attn, q, cache['mem_k'], cache['mem_v'], memory_mask)))
+    ff = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+    return layer.norm3(x + layer.dropout3(ff))
+
+
+def _decoder_layer_packed(layer, x, keep, memory, memory_mask):
+    """Run one post-norm ``nn.TransformerDecoderLayer`` on packed target tokens."""
+    attn = layer.self_attn
+    qkv = pad_packed(F.linear(x, attn.in_proj_weight, attn.in_proj_bias), keep)
+    q, k, v = [split_heads(t, attn.num_heads) for t in qkv.chunk(3, dim=-1)]
+    x = layer.norm1(x + layer.dropout1(cached_attention(attn, q, k, v, is_causal=True, keep=keep)))
+    attn = layer.multihead_attn
+    d = attn.embed_dim
+    bias = attn.in_proj_bias[:d] if attn.in_proj_bias is not None else None
+    q = split_heads(pad_packed(F.linear(x, attn.in_proj_weight[:d], bias), keep), attn.num_heads)
+    k = attention_projection(attn, memory, 1)
+    v = attention_projection(attn, memory, 2)
+    x = layer.norm2(x + layer.dropout2(cached_attention(attn, q, k, v, memory_mask, keep=keep)))
+    ff = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+    return layer.norm3(x + layer.dropout3(ff))
@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from .evaluate import load_model, batched_greedy_decode
+
+
+class RequestError(ValueError):
+    """A request the model cannot translate; the server answers it with 400."""
+
+
+class MicroBatcher:
+    """Queue translation requests and decode them in micro-batches.
+
+    A batch starts with the oldest waiting request and takes every request
+    that arrives within ``window_ms`` of it, up to ``max_batch``. Batches
+    are decoded one at a time in a worker thread, so requests arriving
+    during a decode wait in the queue and join the next batch. If a batch
+    fails, its requests are decoded again one by one, so only the requests
+    that fail on their own get the error.
+    """
+    def __init__(self, model, src_vocab, tgt_vocab, device, max_batch=32,
+                 window_ms=5.0, max_len=100, history=10000):
+        self.model = model
+        self.src_vocab = src_vocab
+        self.tgt_vocab = tgt_vocab
+        self.inv_tgt_vocab = {i: t for t, i in tgt_vocab.items()}
+        self.device = device
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.max_len = max_len
+        # sources beyond the positional encoding cannot be encoded
+        self.max_src_len = model.pos_enc.pe.size(1)
+        self.queue = asyncio.Queue()
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.requests = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def translate(self, text):
+        ids = [self.src_vocab.get(tok, self.src_vocab['<unk>']) for tok in text.split()]
+        if not ids:
+            return ''
+        if len(ids) > self.max_src_len:
+            raise RequestError(f'source has {len(ids)} tokens, at most '
+                               f'{self.max_src_len} are supported')
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        await self.queue.put((ids, future))
+        pred = await future
+        self.latencies.append(time.perf_counter() - start)
+        self.requests += 1
+        return ' '.join(self.inv_tgt_vocab[i] for i in pred if i != self.tgt_vocab['<eos>'])
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # the window is over; whatever already queued up joins too
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.batch_sizes.append(len(batch))
+            try:
+                preds = await loop.run_in_executor(
+                    self._executor, self._decode, [ids for ids, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    _finish(batch[0][1], exception=e)
+                    continue
+                # one bad request must not fail the others in its batch
+                preds = []
+                for ids, future in batch:
+                    try:
+                        preds.extend(await loop.run_in_executor(self._executor, self._decode, [ids]))
+                    except Exception as err:
+                        _finish(future, exception=err)
+                        preds.append(None)
+            for (_, future), pred in zip(batch, preds):
+                if pred is not None:
+                    _finish(future, pred)
+
+    @torch.inference_mode()
+    def _decode(self, src_batch):
+        return batched_greedy_decode(self.model, src_batch, self.tgt_vocab, self.device,
+                                     [self.max_len] * len(src_batch))
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return 0.0
+            return 1000 * latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+        batches = len(self.batch_sizes)
+        return {
+            'queue_depth': self.queue.qsize(),
+            'requests': self.requests,
+            'mean_batch_size': sum(self.batch_sizes) / batches if batches else 0.0,
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99),
+        }
+
+
+def _finish(future, result=None, exception=None):
+    # a client that went away has cancelled its future
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            500: 'Internal Server Error'}
+
+
+async def _handle(batcher, reader, writer):
+    """Serve HTTP/1.1 requests on one connection until the client closes it."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if path == '/translate' and method == 'POST':
+                try:
+                    text = json.loads(body)['src']
+                except (ValueError, KeyError, TypeError):
+                    text = None
+                if not isinstance(text, str):
+                    status, payload = 400, {'error': 'expected a JSON body {"src": "..."}'}
+                else:
+                    try:
+                        status, payload = 200, {'tgt': await batcher.translate(text)}
+                    except RequestError as e:
+                        status, payload = 400, {'error': str(e)}
+                    except Exception as e:
+                        status, payload = 500, {'error': f'translation failed: {e}'}
+            elif path == '/stats' and method == 'GET':
+                status, payload = 200, batcher.stats()
+            elif path in ('/translate', '/stats'):
+                status, payload = 405, {'error': f'{method} not allowed'}
+            else:
+                status, payload = 404, {'error': f'unknown path {path}'}
+
+            data = json.dumps(payload).encode()
+            close = headers.get('connection', '').lower() == 'close'
+            writer.write(
+                f'HTTP/1.1 {status} {_REASONS[status]}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(data)}\r\n'
+                f'Connection: {"close" if close else "keep-alive"}\r\n\r\n'.encode() + data)
+            await writer.drain()
+            if close:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(batcher, host='127.0.0.1', port=8000, unix=None):
+    worker = asyncio.create_task(batcher.run())
+    handler = lambda r, w: _handle(batcher, r, w)
+    if unix:
+        server = await asyncio.start_unix_server(handler, path=unix)
+        print(f'Serving on unix socket {unix}')
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        print(f'Serving on http://{host}:{port}')
+    async with server:
+        await server.serve_forever()
+    worker.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a seq2seq model over HTTP')
+    parser.add_argument('--model', required=True, help='Path to trained model')
+    parser.add_argument('--d-model', type=int, default=128)
+    parser.add_argument('--nhead', type=int, default=4)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--dim-ff', type=int, default=512)
+    parser.add_argument('--dropout', type=float, default=0.1)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', type=str, default=None,
+                        help='Listen on this Unix socket path instead of TCP')
+    parser.add_argument('--max-batch', type=int, default=32,
+                        help='Largest number of requests decoded together')
+    parser.add_argument('--batch-window-ms', type=float, default=5.0,
+                        help='How long the first request of a batch waits for others')
+    parser.add_argument('--max-len', type=int, default=100,
+                        help='Maximum number of target tokens per translation')
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model, src_vocab, tgt_vocab = load_model(
+        args.model, device, args.d_model, args.nhead, args.num_layers, args.dim_ff, args.dropout
+    )
+    # quantized checkpoints are always loaded on the CPU
+    device = next(model.parameters()).device
+    batcher = MicroBatcher(model, src_vocab, tgt_vocab, device, args.max_batch,
+                           args.batch_window_ms, args.max_len)
+    try:
+        asyncio.run(serve(batcher, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import argparse
+import time
+import numpy as np
+import torch
+
+
+class Shortlist:
+    """Target tokens that may appear in the translation of a source batch.
+
+    Built from source/target co-occurrence in the training pairs: every
+    source token keeps the ``top_k`` target tokens found most often in the
+    same pair, and the ``frequent`` most common target tokens plus ``<unk>``
+    and ``<eos>`` are always included. ``select`` returns the sorted union
+    for a batch, or ``None`` to decode over the full vocabulary when a source
+    token never occurred in training or the union covers more than
+    ``max_fraction`` of the vocabulary.
+    """
+    def __init__(self, candidates, always, tgt_vocab_size, max_fraction=0.5):
+        # candidates[s] holds the target ids of source id s, padded with -1;
+        # a row of only -1 marks a source token the index knows nothing about
+        self.candidates = candidates
+        self.covered = (candidates >= 0).any(dim=1)
+        self.always = always
+        self.tgt_vocab_size = tgt_vocab_size
+        self.max_fraction = max_fraction
+
+    @classmethod
+    def from_data(cls, data, src_vocab, tgt_vocab, top_k=20, frequent=50, max_fraction=0.5):
+        """Build the index from ``(src_ids, tgt_ids)`` pairs, e.g. ``dataset.data``."""
+        n_src, n_tgt = len(src_vocab), len(tgt_vocab)
+        specials = [tgt_vocab[t] for t in ('<pad>', '<bos>', '<eos>') if t in tgt_vocab]
+        keys, tgt_sets = [], []
+        for src_ids, tgt_ids in data:
+            s = np.unique(np.asarray(src_ids, dtype=np.int64))
+            t = np.setdiff1d(np.asarray(tgt_ids, dtype=np.int64), specials)
+            keys.append((s[:, None] * n_tgt + t[None, :]).ravel())
+            tgt_sets.append(t)
+        keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+        rows, cols = keys // n_tgt, keys % n_tgt
+        # most frequent partners first within each source row
+        order = np.lexsort((-counts, rows))
+        rows, cols = rows[order], cols[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = rank < top_k
+        candidates = np.full((n_src, top_k), -1, dtype=np.int64)
+        candidates[rows[keep], rank[keep]] = cols[keep]
+        candidates[src_vocab.get('<pad>', 0)] = -1
+        # a word unseen in training can only come out as <unk>, which is always
+        # shortlisted, so a source <unk> must not force the full vocabulary
+        unk = src_vocab.get('<unk>')
+        if unk is not None and '<unk>' in tgt_vocab and (candidates[unk] < 0).all():
+            candidates[unk, 0] = tgt_vocab['<unk>']
+
+        pair_counts = np.bincount(np.concatenate(tgt_sets), minlength=n_tgt)
+        pair_counts[specials] = 0
+        always = np.argsort(-pair_counts, kind='stable')[:frequent]
+        always = always[pair_counts[always] > 0]
+        always = np.union1d(always, [tgt_vocab[t] for t in ('<unk>', '<eos>') if t in tgt_vocab])
+        return cls(torch.from_numpy(candidates), torch.from_numpy(always.astype(np.int64)),
+                   n_tgt, max_fraction)
+
+    def select(self, src):
+        """Return the sorted target ids for the source id tensor ``src``, or ``None``."""
+        ids = torch.unique(src[src != 0]).cpu()
+        if not self.covered[ids].all():
+            return None
+        found = self.candidates[ids].view(-1)
+        shortlist = torch.unique(torch.cat([found[found >= 0], self.always]))
+        if len(shortlist) > self.max_fraction * self.tgt_vocab_size:
+            return None
+        return shortlist.to(src.device)
+
+    def state_dict(self):
+        return {'candidates': self.candidates, 'always': self.always,
+                'tgt_vocab_size': self.tgt_vocab_size, 'max_fraction': self.max_fraction}
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path, max_fraction=None):
+        state = torch.load(path)
+        if max_fraction is not None:
+            state['max_fraction'] = max_fraction
+        return cls(**state)
+
+
+def _decode(model, dataset, device, batch_size, shortlist):
+    from .evaluate import decode_dataset
+
+    selected = []
+    if shortlist is not None:
+        # shortlist sizes of the batches decode_dataset will form
+        order = sorted(range(len(dataset.data)), key=lambda i: len(dataset.data[i][0]))
+        for start in range(0, len(order), batch_size):
+            src = torch.tensor([i for j in order[start:start + batch_size]
+                                for i in dataset.data[j][0]])
+            ids = shortlist.select(src)
+            selected.append(None if ids is None else len(ids))
+    start = time.perf_counter()
+    with torch.no_grad():
+        preds = decode_dataset(model, dataset, device, batch_size, shortlist=shortlist)
+    return preds, 1000 * (time.perf_counter() - start) / len(dataset.data), selected
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build a source-conditioned output shortlist and report its '
+                    'accuracy/latency trade-off'
+    )
+    parser.add_argument('--model', required=True, help='Path to trained model')
+    parser.add_argument('--train-src', required=True, help='Training source file')
+    parser.add_argument('--train-tgt', required=True, help='Training target file')
+    parser.add_argument('--top-k', type=int, nargs='+', default=[20],
+                        help='Target tokens kept per source token; the report covers every value')
+    parser.add_argument('--frequent', type=int, default=50,
+                        help='Most frequent target tokens always in the shortlist')
+    parser.add_argument('--max-fraction', type=float, default=0.5,
+                        help='Decode over the full vocabulary when the shortlist is larger')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Save the index built with the first --top-k value')
+    parser.add_argument('--src', type=str, default=None, help='Test source file for the report')
+    parser.add_argument('--tgt', type=str, default=None, help='Test target file for the report')
+    parser.add_argument('--max-sentences', type=int, default=None,
+                        help='Only decode this many test sentences')
+    parser.add_argument('--eval-batch-size', type=int, default=32,
+                        help='Number of sentences decoded together')
+    parser.add_argument('--d-model', type=int, default=128)
+    parser.add_argument('--nhead', type=int, default=4)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--dim-ff', type=int, default=512)
+    parser.add_argument('--dropout', type=float, default=0.1)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Number of CPU threads (defaults to the torch default)')
+    args = parser.parse_args()
+    from .evaluate import load_model, load_tokenized_dataset, score_predictions
+
+    if (args.src is None) != (args.tgt is None):
+        parser.error('--src and --tgt go together')
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cpu')
+    model, src_vocab, tgt_vocab = load_model(
+        args.model, device, args.d_model, args.nhead, args.num_layers, args.dim_ff, args.dropout
+    )
+    train = load_tokenized_dataset(args.train_src, args.train_tgt, src_vocab, tgt_vocab)
+    shortlists = {}
+    for k in args.top_k:
+        start = time.perf_counter()
+        shortlists[k] = Shortlist.from_data(train.data, src_vocab, tgt_vocab, k,
+                                            args.frequent, args.max_fraction)
+        print(f'top-{k} index built in {time.perf_counter() - start:.2f}s')
+    if args.output:
+        shortlists[args.top_k[0]].save(args.output)
+        print('Shortlist saved to', args.output)
+    if args.src is None:
+        return
+
+    dataset = load_tokenized_dataset(args.src, args.tgt, src_vocab, tgt_vocab)
+    if args.max_sentences:
+        dataset.data = dataset.data[:args.max_sentences]
+    full, full_latency, _ = _decode(model, dataset, device, args.eval_batch_size, None)
+    full_metrics = score_predictions(dataset, full)
+    print(f'target vocabulary: {len(tgt_vocab)}, sentences: {len(dataset.data)}, '
+          f'batch size: {args.eval_batch_size}')
+    print(f"{'output':>10}{'size':>8}{'fallback':>10}{'ms/sent':>9}{'speedup':>9}"
+          f"{'tokens':>9}{'exact':>9}{'same':>9}")
+    print(f"{'full':>10}{len(tgt_vocab):8d}{'':>10}{full_latency:9.2f}{'':>9}"
+          f"{100 * full_metrics.token_accuracy:8.2f}%{100 * full_metrics.exact_match:8.2f}%"
+          f"{'':>9}")
+    for k, shortlist in shortlists.items():
+        preds, latency, selected = _decode(model, dataset, device, args.eval_batch_size, shortlist)
+        metrics = score_predictions(dataset, preds)
+        sizes = [n for n in selected if n is not None]
+        size = sum(sizes) / len(sizes) if sizes else float(len(tgt_vocab))
+        fallback = 1 - len(sizes) / len(selected)
+        same = sum(a == b for a, b in zip(preds, full)) / len(full)
+        print(f"{'top-' + str(k):>10}{size:8.0f}{100 * fallback:9.1f}%{latency:9.2f}"
+              f"{full_latency / latency:8.2f}x{100 * metrics.token_accuracy:8.2f}%"
+              f"{100 * metrics.exact_match:8.2f}%{100 * same:8.2f}%")
+
+
+if __name__ == '__main__':
+    main()
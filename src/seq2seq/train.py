@@ -1,14 +1,28 @@
 import argparse
+import contextlib
 import math
+import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
 from .data import build_dataloader
 from .model import Seq2SeqTransformer
-from ..model import generate_square_subsequent_mask
+from ..cache import build_cache
+from ..checkpoint import (
+    CheckpointWriter, load_checkpoint, resolve_resume, rng_state, set_rng_state,
+)
+from ..perf import autocast, maybe_compile, ThroughputMeter, StepRecorder, ProfileWindow, rank_path
+from ..distributed import launch, is_main, main_first, all_reduce_sum, all_reduce_max
 import tqdm
 
-def evaluate(model, loader, criterion, device):
+def _loss_inputs(out, tgt_out, tgt_pad_mask, packed):
+    """Flatten logits and targets for the loss, dropping padding when packed."""
+    if packed:
+        return out, tgt_out[~tgt_pad_mask]
+    return out.reshape(-1, out.size(-1)), tgt_out.reshape(-1)
+
+def evaluate(model, loader, criterion, device, precision='fp32', packed=True):
     model.eval()
     total_loss = 0.0
     with torch.no_grad():
@@ -17,67 +31,215 @@ def evaluate(model, loader, criterion, device):
             tgt = tgt.to(device)
             tgt_inp = tgt[:, :-1]
             tgt_out = tgt[:, 1:]
-            tgt_mask = generate_square_subsequent_mask(tgt_inp.size(1)).to(device)
             src_pad_mask = src == 0
             tgt_pad_mask = tgt_inp == 0
-            out = model(src, tgt_inp, tgt_mask=tgt_mask,
-                        src_padding_mask=src_pad_mask,
-                        tgt_padding_mask=tgt_pad_mask)
-            loss = criterion(out.reshape(-1, out.size(-1)), tgt_out.reshape(-1))
+            with autocast(device, precision):
+                out = model(src, tgt_inp, src_padding_mask=src_pad_mask,
+                            tgt_padding_mask=tgt_pad_mask, tgt_is_causal=True, packed=packed)
+                loss = criterion(*_loss_inputs(out, tgt_out, tgt_pad_mask, packed))
             total_loss += loss.item() * src.size(0)
     return total_loss / len(loader.dataset)
 
+def _accumulation_windows(batches, accum_steps):
+    """Group consecutive batches into lists of ``accum_steps`` micro-batches."""
+    window = []
+    for batch in batches:
+        window.append(batch)
+        if len(window) == accum_steps:
+            yield window
+            window = []
+    if window:
+        yield window
+
 def train(args):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    dataset, train_loader = build_dataloader(
-        args.src, args.tgt, args.batch_size, args.min_freq, shuffle=True)
+    if args.accum_steps < 1:
+        raise ValueError('--accum-steps must be at least 1')
+    if args.max_tokens is None and args.batch_size % args.world_size:
+        raise ValueError('--batch-size must be divisible by --world-size')
+    launch(_train_worker, args, args.world_size)
 
-    if dataset.src_unk_count or dataset.tgt_unk_count:
-        print(f"<unk> tokens - src: {dataset.src_unk_count}, tgt: {dataset.tgt_unk_count}")
+def _train_worker(rank, world_size, args):
+    distributed = world_size > 1
+    if distributed:
+        device = torch.device('cpu')
     else:
-        print("No <unk> tokens in training data")
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(args.seed)
+    cache = build_cache(args.cache_dir, args.cache_size_mb)
+    # --batch-size and --max-tokens are global; each process takes its share
+    if args.max_tokens is not None:
+        batch_size, max_tokens = None, args.max_tokens // world_size
+    else:
+        batch_size, max_tokens = args.batch_size // world_size, None
+    with main_first():
+        dataset, train_loader = build_dataloader(
+            args.src, args.tgt, batch_size, args.min_freq, shuffle=True,
+            streaming=args.streaming, vocab_path=args.vocab,
+            shuffle_buffer=args.shuffle_buffer, num_workers=args.num_workers,
+            bucket=args.bucket, max_tokens=max_tokens, pin_memory=args.pin_memory, cache=cache,
+            num_replicas=world_size, rank=rank, seed=args.seed)
+
+    if is_main():
+        if dataset.src_unk_count or dataset.tgt_unk_count:
+            print(f"<unk> tokens - src: {dataset.src_unk_count}, tgt: {dataset.tgt_unk_count}")
+        else:
+            print("No <unk> tokens in training data")
 
     val_loader = None
-    if args.eval_src and args.eval_tgt:
+    if args.eval_src and args.eval_tgt and is_main():
         _, val_loader = build_dataloader(
-            args.eval_src, args.eval_tgt, args.batch_size, args.min_freq)
+            args.eval_src, args.eval_tgt, args.batch_size, args.min_freq, cache=cache)
     model = Seq2SeqTransformer(
         len(dataset.src_vocab), len(dataset.tgt_vocab),
         args.d_model, args.nhead, args.num_layers,
         args.dim_ff, args.dropout
     ).to(device)
     criterion = nn.CrossEntropyLoss(ignore_index=dataset.tgt_vocab['<pad>'])
+    # summed token losses, normalised below by the global token count so the
+    # gradient does not depend on how a batch is split between processes
+    sum_criterion = nn.CrossEntropyLoss(ignore_index=dataset.tgt_vocab['<pad>'], reduction='sum')
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
-    for epoch in range(1, args.epochs + 1):
+    start_epoch, start_step, global_step, resume_rng = 1, 0, 0, None
+    if args.resume:
+        path = resolve_resume(args.resume)
+        checkpoint = load_checkpoint(path)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        start_epoch, start_step = checkpoint['epoch'], checkpoint['epoch_step']
+        global_step, resume_rng = checkpoint['step'], checkpoint['rng_state']
+        if is_main():
+            print(f"Resuming from {path} at epoch {start_epoch}, step {start_step}")
+    writer = None
+    if args.ckpt_dir and is_main():
+        writer = CheckpointWriter(args.ckpt_dir, args.keep_ckpts)
+
+    def checkpoint_state(epoch, epoch_step):
+        # the RNG state is taken where training resumes, so dropout masks
+        # after a resume match an uninterrupted run
+        return {'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'rng_state': rng_state(), 'epoch': epoch, 'epoch_step': epoch_step,
+                'step': global_step,
+                'src_vocab': dataset.src_vocab, 'tgt_vocab': dataset.tgt_vocab}
+
+    train_model = DistributedDataParallel(model) if distributed else model
+    train_model = maybe_compile(train_model, args.compile)
+    recorder = StepRecorder(
+        args.step_log and rank_path(args.step_log, rank, world_size), device)
+    profiler = None
+    if args.profile_steps:
+        profiler = ProfileWindow(args.profile_steps, os.path.join(
+            args.profile_dir, rank_path('trace.json', rank, world_size)), device)
+    for epoch in range(start_epoch, args.epochs + 1):
         model.train()
+        for source in (train_loader.dataset, train_loader.sampler, train_loader.batch_sampler):
+            if hasattr(source, 'set_epoch'):
+                source.set_epoch(epoch)
         total_loss = 0.0
-        for src, tgt in tqdm.tqdm(train_loader):
-            src = src.to(device)
-            tgt = tgt.to(device)
-            tgt_inp = tgt[:, :-1]
-            tgt_out = tgt[:, 1:]
-            tgt_mask = generate_square_subsequent_mask(tgt_inp.size(1)).to(device)
-            src_pad_mask = src == 0
-            tgt_pad_mask = tgt_inp == 0
+        total_tokens = 0
+        real_tokens = 0
+        padded_tokens = 0
+        meter = ThroughputMeter()
+        # batches before the resume position are read again but not trained on
+        skip = start_step if epoch == start_epoch else 0
+        if resume_rng is not None and not skip:
+            set_rng_state(resume_rng)
+            resume_rng = None
+        batches = tqdm.tqdm(train_loader, disable=not is_main())
+        recorder.reset()
+        for epoch_step, window in enumerate(_accumulation_windows(batches, args.accum_steps)):
+            if epoch_step < skip:
+                continue
+            if resume_rng is not None:
+                set_rng_state(resume_rng)
+                resume_rng = None
+            if profiler:
+                profiler.step_started(global_step + 1)
+            recorder.begin(epoch=epoch, step=global_step + 1)
+            meter.start()
+            # the loss of every micro-batch is divided by the token count of
+            # the whole window, so the accumulated gradient equals the
+            # gradient of one large batch
+            window_tokens = sum(int((tgt[:, 1:] != 0).sum()) for _, tgt in window)
+            global_tokens = all_reduce_sum(window_tokens)
             optimizer.zero_grad()
-            out = model(src, tgt_inp, tgt_mask=tgt_mask,
-                        src_padding_mask=src_pad_mask,
-                        tgt_padding_mask=tgt_pad_mask)
-            loss = criterion(out.reshape(-1, out.size(-1)), tgt_out.reshape(-1))
-            loss.backward()
-            optimizer.step()
-            total_loss += loss.item() * src.size(0)
-        avg_loss = total_loss / len(train_loader.dataset)
-        ppl = math.exp(avg_loss)
-        print(f"Epoch {epoch}: loss={avg_loss:.4f} ppl={ppl:.4f}")
+            step_tokens = 0
+            step_padded = 0
+            step_loss = 0.0
+            for i, (src, tgt) in enumerate(window):
+                with recorder.phase('h2d'):
+                    src = src.to(device)
+                    tgt = tgt.to(device)
+                tgt_inp = tgt[:, :-1]
+                tgt_out = tgt[:, 1:]
+                src_pad_mask = src == 0
+                tgt_pad_mask = tgt_inp == 0
+                # gradients are only all-reduced after the last micro-batch
+                sync = not distributed or i == len(window) - 1
+                with (contextlib.nullcontext() if sync else train_model.no_sync()):
+                    with recorder.phase('forward'), autocast(device, args.precision):
+                        out = train_model(src, tgt_inp, src_padding_mask=src_pad_mask,
+                                          tgt_padding_mask=tgt_pad_mask, tgt_is_causal=True,
+                                          packed=not args.padded)
+                        loss_sum = sum_criterion(*_loss_inputs(out, tgt_out, tgt_pad_mask,
+                                                               not args.padded))
+                    # DDP averages gradients over processes, hence the world_size factor
+                    with recorder.phase('backward'):
+                        (loss_sum * world_size / max(global_tokens, 1)).backward()
+                step_loss += loss_sum.item()
+                step_tokens += int((src != 0).sum()) + int((tgt != 0).sum())
+                step_padded += src.numel() + tgt.numel()
+            with recorder.phase('optimizer'):
+                optimizer.step()
+            total_loss += step_loss
+            total_tokens += window_tokens
+            real_tokens += step_tokens
+            padded_tokens += step_padded
+            meter.stop(step_tokens)
+            global_step += 1
+            recorder.end(real_tokens=step_tokens, padded_tokens=step_padded,
+                         loss=step_loss / max(window_tokens, 1))
+            if profiler:
+                profiler.step_finished(global_step)
+            if writer and args.ckpt_every and global_step % args.ckpt_every == 0:
+                writer.save(checkpoint_state(epoch, epoch_step + 1), global_step)
+        total_loss, total_tokens, real_tokens, padded_tokens, meter_tokens = all_reduce_sum(
+            total_loss, total_tokens, real_tokens, padded_tokens, meter.tokens)
+        elapsed = all_reduce_max(meter.elapsed)
+        if is_main():
+            avg_loss = total_loss / max(total_tokens, 1)
+            ppl = math.exp(avg_loss)
+            print(f"Epoch {epoch}: loss={avg_loss:.4f} ppl={ppl:.4f} "
+                  f"padding efficiency={real_tokens / max(padded_tokens, 1):.2%}")
+            print(f"  Throughput: {meter.summary()}")
+            if distributed:
+                tps = meter_tokens / elapsed if elapsed else 0.0
+                line = f"  Global: {tps:.0f} tokens/s over {world_size} processes"
+                if args.baseline_tps:
+                    line += f", scaling efficiency={tps / (world_size * args.baseline_tps):.2%}"
+                print(line)
+            dropped = getattr(train_loader.batch_sampler, 'dropped', 0)
+            if dropped:
+                print(f"  {dropped} examples left out: too few to give every process one")
+        if writer:
+            writer.save(checkpoint_state(epoch + 1, 0), global_step)
         if val_loader:
-            val_loss = evaluate(model, val_loader, criterion, device)
+            val_loss = evaluate(model, val_loader, criterion, device, args.precision,
+                                not args.padded)
             val_ppl = math.exp(val_loss)
             print(f"  Val : loss={val_loss:.4f} ppl={val_ppl:.4f}")
-    torch.save({'model_state_dict': model.state_dict(),
-                'src_vocab': dataset.src_vocab,
-                'tgt_vocab': dataset.tgt_vocab}, args.output)
-    print('Training completed. Model saved to', args.output)
+    if writer:
+        writer.close()
+    if profiler:
+        profiler.close()
+        if is_main():
+            print('Profiler trace written to', args.profile_dir)
+    recorder.close()
+    if is_main():
+        torch.save({'model_state_dict': model.state_dict(),
+                    'src_vocab': dataset.src_vocab,
+                    'tgt_vocab': dataset.tgt_vocab}, args.output)
+        print('Training completed. Model saved to', args.output)
 
 def main():
     parser = argparse.ArgumentParser(description='Train seq2seq Transformer')
@@ -95,6 +257,53 @@ def main():
     parser.add_argument('--dim-ff', type=int, default=512)
     parser.add_argument('--dropout', type=float, default=0.1)
     parser.add_argument('--output', type=str, default='seq2seq_model.pt')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Tokenize the training files lazily instead of loading them')
+    parser.add_argument('--vocab', type=str, default=None,
+                        help='Vocabulary file to load, or to save to if missing (streaming mode)')
+    parser.add_argument('--shuffle-buffer', type=int, default=10000,
+                        help='Examples held for shuffling in streaming mode')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='DataLoader worker processes')
+    parser.add_argument('--bucket', action='store_true',
+                        help='Batch sentences of similar length together')
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help='Batch by padded source plus target tokens instead of --batch-size')
+    parser.add_argument('--accum-steps', type=int, default=1,
+                        help='Micro-batches accumulated into each optimizer step')
+    parser.add_argument('--pin-memory', action='store_true',
+                        help='Return batches in pinned memory for faster device copies')
+    parser.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32',
+                        help='Run forward passes under bf16 autocast')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile the model with torch.compile (dynamic shapes)')
+    parser.add_argument('--padded', action='store_true',
+                        help='Run the decoder over padded targets instead of packing out the '
+                             'padding, e.g. to keep --compile graphs free of data-dependent shapes')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for model initialisation and data shuffling')
+    parser.add_argument('--world-size', type=int, default=1,
+                        help='Number of data-parallel CPU processes (gloo backend)')
+    parser.add_argument('--baseline-tps', type=float, default=None,
+                        help='Single-process tokens/s used to report scaling efficiency')
+    parser.add_argument('--step-log', type=str, default=None,
+                        help='Write per-step phase timings, token counts and peak memory as JSONL')
+    parser.add_argument('--profile-steps', type=str, default=None,
+                        help='Optimizer steps to trace with torch.profiler, e.g. 20-25')
+    parser.add_argument('--profile-dir', type=str, default='profile',
+                        help='Directory for the profiler trace')
+    parser.add_argument('--ckpt-dir', type=str, default=None,
+                        help='Directory for resumable checkpoints, written after every epoch')
+    parser.add_argument('--ckpt-every', type=int, default=0,
+                        help='Also checkpoint every N optimizer steps')
+    parser.add_argument('--keep-ckpts', type=int, default=3,
+                        help='Number of most recent checkpoints to keep')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='Checkpoint file, or checkpoint directory to resume from its newest file')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory caching tokenized data across runs')
+    parser.add_argument('--cache-size-mb', type=float, default=1024,
+                        help='Size limit of the cache directory')
     args = parser.parse_args()
     train(args)
 
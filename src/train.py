@@ -1,99 +1,215 @@
 import argparse
 import math
+import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
 from .data import build_dataloader
-from .model import TransformerLM, generate_square_subsequent_mask
+from .model import TransformerLM
+from .cache import build_cache
+from .checkpoint import (
+    CheckpointWriter, load_checkpoint, resolve_resume, rng_state, set_rng_state,
+)
+from .perf import autocast, maybe_compile, ThroughputMeter, StepRecorder, ProfileWindow, rank_path
+from .distributed import launch, is_main, main_first, all_reduce_sum, all_reduce_max
 import tqdm
 
-def evaluate(model, data_loader, criterion, device):
+def lm_loss(model, src, tgt, criterion, adaptive=False):
+    """Mean next-token loss of ``model`` (possibly DDP-wrapped) on a batch.
+
+    The adaptive softmax head computes its loss inside ``forward`` without
+    full-vocabulary logits.
+    """
+    if adaptive:
+        return model(src, is_causal=True, targets=tgt)
+    output = model(src, is_causal=True)
+    return criterion(output.reshape(-1, output.size(-1)), tgt.view(-1))
+
+
+def evaluate(model, data_loader, criterion, device, precision='fp32'):
     model.eval()
     total_loss = 0.0
     with torch.no_grad():
         for src, tgt in data_loader:
             # src, tgt: [batch, seq]
-            src = src.to(device)
-            tgt = tgt.to(device)
-            seq_len = src.size(1)
-            # dynamic mask matching batch sequence length
-            mask = generate_square_subsequent_mask(seq_len).to(device)
-
-            output = model(src, mask)
-            loss = criterion(
-                output.reshape(-1, output.size(-1)),
-                tgt.view(-1)
-            )
+            # samples are uint16/uint32 views of the token file
+            src = src.to(device).long()
+            tgt = tgt.to(device).long()
+            with autocast(device, precision):
+                loss = lm_loss(model, src, tgt, criterion, model.adaptive is not None)
             total_loss += loss.item() * src.size(0)
     return total_loss / len(data_loader.dataset)
 
 
 def train(args):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if args.batch_size % args.world_size:
+        raise ValueError('--batch-size must be divisible by --world-size')
+    launch(_train_worker, args, args.world_size)
 
-    # build data loaders
-    dataset, train_loader = build_dataloader(
-        args.corpus, args.seq_len, args.batch_size
-    )
+
+def _train_worker(rank, world_size, args):
+    distributed = world_size > 1
+    if distributed:
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(args.seed)
+
+    # build data loaders; --batch-size is split between processes
+    cache = build_cache(args.cache_dir, args.cache_size_mb)
+    with main_first():
+        dataset, train_loader = build_dataloader(
+            args.corpus, args.seq_len, args.batch_size // world_size, cache=cache,
+            num_replicas=world_size, rank=rank, seed=args.seed, voc_limit=args.voc_limit
+        )
     val_loader = None
-    if args.eval_corpus:
+    if args.eval_corpus and is_main():
         _, val_loader = build_dataloader(
-            args.eval_corpus, args.seq_len, args.batch_size
+            args.eval_corpus, args.seq_len, args.batch_size, cache=cache,
+            voc_limit=args.voc_limit
         )
 
     vocab_size = len(dataset.vocab)
     
-    print(f"Loaded dataset with vocab : {vocab_size}")
+    if is_main():
+        print(f"Loaded dataset with vocab : {vocab_size}")
     model = TransformerLM(
         vocab_size,
         args.d_model,
         args.nhead,
         args.num_layers,
         args.dim_ff,
-        args.dropout
+        args.dropout,
+        args.adaptive_cutoffs,
+        args.adaptive_div_value
     ).to(device)
+    adaptive = model.adaptive is not None
+    head = {'cutoffs': args.adaptive_cutoffs, 'div_value': args.adaptive_div_value}
 
     # ignore padding index
     criterion = nn.CrossEntropyLoss(ignore_index=dataset.vocab['<pad>'])
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    start_epoch, start_step, global_step, resume_rng = 1, 0, 0, None
+    if args.resume:
+        path = resolve_resume(args.resume)
+        checkpoint = load_checkpoint(path)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        start_epoch, start_step = checkpoint['epoch'], checkpoint['epoch_step']
+        global_step, resume_rng = checkpoint['step'], checkpoint['rng_state']
+        if is_main():
+            print(f"Resuming from {path} at epoch {start_epoch}, step {start_step}")
+    writer = None
+    if args.ckpt_dir and is_main():
+        writer = CheckpointWriter(args.ckpt_dir, args.keep_ckpts)
+
+    def checkpoint_state(epoch, epoch_step):
+        # the RNG state is taken where training resumes, so dropout masks
+        # after a resume match an uninterrupted run
+        return {'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'rng_state': rng_state(), 'epoch': epoch, 'epoch_step': epoch_step,
+                'step': global_step, 'vocab': dataset.vocab, 'seq_len': args.seq_len, **head}
+
+    # every process sees the same number of equally sized batches, so
+    # DDP's gradient average equals the single-process batch mean; the
+    # sampler leaves out the last len(dataset) % world_size windows of each
+    # epoch's permutation instead of repeating others to fill the processes
+    train_model = model
+    if distributed:
+        # adaptive softmax clusters without targets in a batch get no gradient
+        train_model = DistributedDataParallel(model, find_unused_parameters=adaptive)
+    train_model = maybe_compile(train_model, args.compile)
+    recorder = StepRecorder(
+        args.step_log and rank_path(args.step_log, rank, world_size), device)
+    profiler = None
+    if args.profile_steps:
+        profiler = ProfileWindow(args.profile_steps, os.path.join(
+            args.profile_dir, rank_path('trace.json', rank, world_size)), device)
 
-    for epoch in range(1, args.epochs + 1):
+    for epoch in range(start_epoch, args.epochs + 1):
         model.train()
+        train_loader.sampler.set_epoch(epoch)
         total_loss = 0.0
-        for src, tgt in tqdm.tqdm(train_loader):
+        total_samples = 0
+        meter = ThroughputMeter()
+        # batches before the resume position are read again but not trained on
+        skip = start_step if epoch == start_epoch else 0
+        if resume_rng is not None and not skip:
+            set_rng_state(resume_rng)
+            resume_rng = None
+        recorder.reset()
+        for epoch_step, (src, tgt) in enumerate(tqdm.tqdm(train_loader, disable=not is_main())):
+            if epoch_step < skip:
+                continue
+            if resume_rng is not None:
+                set_rng_state(resume_rng)
+                resume_rng = None
+            if profiler:
+                profiler.step_started(global_step + 1)
+            recorder.begin(epoch=epoch, step=global_step + 1)
+            meter.start()
             # src, tgt: [batch, seq]
-            src = src.to(device)
-            tgt = tgt.to(device)
-            seq_len = src.size(1)
-
-            # generate mask for this batch
-            mask = generate_square_subsequent_mask(seq_len).to(device)
+            with recorder.phase('h2d'):
+                src = src.to(device).long()
+                tgt = tgt.to(device).long()
 
             optimizer.zero_grad()
-            output = model(src, mask)
-            loss = criterion(
-                output.reshape(-1, output.size(-1)),
-                tgt.view(-1)
-            )
-            loss.backward()
-            optimizer.step()
+            with recorder.phase('forward'), autocast(device, args.precision):
+                loss = lm_loss(train_model, src, tgt, criterion, adaptive)
+            with recorder.phase('backward'):
+                loss.backward()
+            with recorder.phase('optimizer'):
+                optimizer.step()
 
             total_loss += loss.item() * src.size(0)
+            total_samples += src.size(0)
+            meter.stop(src.numel())
+            global_step += 1
+            # stride-1 windows never need padding
+            recorder.end(real_tokens=src.numel(), padded_tokens=src.numel(), loss=loss.item())
+            if profiler:
+                profiler.step_finished(global_step)
+            if writer and args.ckpt_every and global_step % args.ckpt_every == 0:
+                writer.save(checkpoint_state(epoch, epoch_step + 1), global_step)
 
-        avg_loss = total_loss / len(train_loader.dataset)
-        ppl = math.exp(avg_loss)
-        print(f"Epoch {epoch}: loss={avg_loss:.4f} ppl={ppl:.4f}")
+        total_loss, total_samples, meter_tokens = all_reduce_sum(
+            total_loss, total_samples, meter.tokens)
+        elapsed = all_reduce_max(meter.elapsed)
+        if is_main():
+            avg_loss = total_loss / max(total_samples, 1)
+            ppl = math.exp(avg_loss)
+            print(f"Epoch {epoch}: loss={avg_loss:.4f} ppl={ppl:.4f}")
+            print(f"  Throughput: {meter.summary()}")
+            if distributed:
+                tps = meter_tokens / elapsed if elapsed else 0.0
+                line = f"  Global: {tps:.0f} tokens/s over {world_size} processes"
+                if args.baseline_tps:
+                    line += f", scaling efficiency={tps / (world_size * args.baseline_tps):.2%}"
+                print(line)
+        if writer:
+            writer.save(checkpoint_state(epoch + 1, 0), global_step)
 
         if val_loader:
-            val_loss = evaluate(model, val_loader, criterion, device)
+            val_loss = evaluate(model, val_loader, criterion, device, args.precision)
             val_ppl = math.exp(val_loss)
             print(f"  Val : loss={val_loss:.4f} ppl={val_ppl:.4f}")
 
-    torch.save(
-        {'model_state_dict': model.state_dict(), 'vocab': dataset.vocab},
-        args.output
-    )
-    print('Training completed. Model saved to', args.output)
+    if writer:
+        writer.close()
+    if profiler:
+        profiler.close()
+        if is_main():
+            print('Profiler trace written to', args.profile_dir)
+    recorder.close()
+    if is_main():
+        torch.save(
+            {'model_state_dict': model.state_dict(), 'vocab': dataset.vocab,
+             'seq_len': args.seq_len, **head},
+            args.output
+        )
+        print('Training completed. Model saved to', args.output)
 
 
 if __name__ == '__main__':
@@ -144,9 +260,77 @@ if __name__ == '__main__':
         '--dropout', type=float, default=0.1,
         help='Dropout rate'
     )
+    parser.add_argument(
+        '--voc-limit', type=int, default=None,
+        help='Keep only the most frequent tokens, e.g. 4000 as in the JoeyNMT configs'
+    )
+    parser.add_argument(
+        '--adaptive-cutoffs', type=int, nargs='+', default=None,
+        help='Use an adaptive softmax head with these cluster boundaries, e.g. 1000 2000'
+    )
+    parser.add_argument(
+        '--adaptive-div-value', type=float, default=4.0,
+        help='Width ratio between successive adaptive softmax clusters'
+    )
     parser.add_argument(
         '--output', type=str, default='model.pt',
         help='Output path for the saved model'
     )
+    parser.add_argument(
+        '--precision', choices=['fp32', 'bf16'], default='fp32',
+        help='Run forward passes under bf16 autocast'
+    )
+    parser.add_argument(
+        '--compile', action='store_true',
+        help='Compile the model with torch.compile (dynamic shapes)'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed for model initialisation and data shuffling'
+    )
+    parser.add_argument(
+        '--world-size', type=int, default=1,
+        help='Number of data-parallel CPU processes (gloo backend)'
+    )
+    parser.add_argument(
+        '--baseline-tps', type=float, default=None,
+        help='Single-process tokens/s used to report scaling efficiency'
+    )
+    parser.add_argument(
+        '--step-log', type=str, default=None,
+        help='Write per-step phase timings, token counts and peak memory as JSONL'
+    )
+    parser.add_argument(
+        '--profile-steps', type=str, default=None,
+        help='Optimizer steps to trace with torch.profiler, e.g. 20-25'
+    )
+    parser.add_argument(
+        '--profile-dir', type=str, default='profile',
+        help='Directory for the profiler trace'
+    )
+    parser.add_argument(
+        '--ckpt-dir', type=str, default=None,
+        help='Directory for resumable checkpoints, written after every epoch'
+    )
+    parser.add_argument(
+        '--ckpt-every', type=int, default=0,
+        help='Also checkpoint every N optimizer steps'
+    )
+    parser.add_argument(
+        '--keep-ckpts', type=int, default=3,
+        help='Number of most recent checkpoints to keep'
+    )
+    parser.add_argument(
+        '--resume', type=str, default=None,
+        help='Checkpoint file, or checkpoint directory to resume from its newest file'
+    )
+    parser.add_argument(
+        '--cache-dir', type=str, default=None,
+        help='Directory caching preprocessed corpora across runs'
+    )
+    parser.add_argument(
+        '--cache-size-mb', type=float, default=1024,
+        help='Size limit of the cache directory'
+    )
     args = parser.parse_args()
     train(args)
@@ -0,0 +1,88 @@
+import pytest
+import torch
+
+from src.model import generate_square_subsequent_mask
+from src.seq2seq.evaluate import batched_greedy_decode, beam_search_decode, greedy_decode
+from src.seq2seq.model import Seq2SeqTransformer
+
+TGT_VOCAB = {'<pad>': 0, '<bos>': 1, '<eos>': 2, **{f'w{i}': i for i in range(3, 20)}}
+SOURCES = [[5, 9, 3, 7], [4, 11], [8, 3, 3, 12, 6, 10, 2], [13]]
+DEVICE = torch.device('cpu')
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(1)
+    model = Seq2SeqTransformer(16, len(TGT_VOCAB), d_model=32, nhead=4, num_layers=2,
+                               dim_feedforward=64, dropout=0.0)
+    # an untrained output layer repeats one token; larger weights give varied
+    # sequences, and with this seed one of them ends in <eos>
+    with torch.no_grad():
+        torch.nn.init.normal_(model.fc_out.weight, std=1.0)
+        model.fc_out.bias.zero_()
+    # float64 keeps the cached and uncached paths from picking different
+    # argmaxes over rounding noise
+    return model.double().eval()
+
+
+def full_prefix_greedy(model, src, max_len):
+    """The decoding loop used before the cache: re-decode the whole prefix each step."""
+    src = torch.tensor([src])
+    memory = model.encode(src, None, src == 0)
+    ys = torch.tensor([[TGT_VOCAB['<bos>']]])
+    for _ in range(max_len):
+        tgt_mask = generate_square_subsequent_mask(ys.size(1))
+        out = model.decode(ys, memory, tgt_mask=tgt_mask,
+                           memory_padding_mask=src == 0, tgt_padding_mask=ys == 0)
+        next_word = model.fc_out(out[:, -1]).argmax(dim=-1).item()
+        ys = torch.cat([ys, torch.tensor([[next_word]])], dim=1)
+        if next_word == TGT_VOCAB['<eos>']:
+            break
+    return ys.squeeze(0).tolist()[1:]
+
+
+def padded(batch):
+    src = torch.zeros(len(batch), max(len(s) for s in batch), dtype=torch.long)
+    for row, ids in enumerate(batch):
+        src[row, :len(ids)] = torch.tensor(ids)
+    return src
+
+
+@pytest.mark.parametrize('chunk', [1, 3])
+@torch.no_grad()
+def test_decode_step_matches_decode(model, chunk):
+    src = padded(SOURCES)
+    memory = model.encode(src, None, src == 0)
+    tgt = torch.randint(3, len(TGT_VOCAB), (len(SOURCES), 9), generator=torch.Generator().manual_seed(1))
+    tgt[:, 0] = TGT_VOCAB['<bos>']
+    full = model.decode(tgt, memory, tgt_mask=generate_square_subsequent_mask(tgt.size(1)),
+                        memory_padding_mask=src == 0)
+    cache = model.init_decode_cache(memory, src == 0)
+    steps = [model.decode_step(tgt[:, i:i + chunk], cache)
+             for i in range(0, tgt.size(1), chunk)]
+    assert cache['pos'] == tgt.size(1)
+    torch.testing.assert_close(torch.cat(steps, dim=1), full)
+
+
+@torch.no_grad()
+def test_greedy_decode_matches_full_prefix_loop(model):
+    for src in SOURCES:
+        expected = full_prefix_greedy(model, src, max_len=12)
+        assert greedy_decode(model, src, None, TGT_VOCAB, DEVICE, max_len=12) == expected
+
+
+@torch.no_grad()
+def test_batched_greedy_decode_matches_full_prefix_loop(model):
+    max_lens = [12, 5, 9, 1]
+    expected = [full_prefix_greedy(model, src, n) for src, n in zip(SOURCES, max_lens)]
+    assert [12, 5, 9] == [len(p) for p in expected[:3]]
+    assert expected[3] == [TGT_VOCAB['<eos>']]
+    assert batched_greedy_decode(model, SOURCES, TGT_VOCAB, DEVICE, max_lens) == expected
+
+
+@torch.no_grad()
+def test_beam_size_one_matches_full_prefix_loop(model):
+    max_lens = [12, 5, 9, 1]
+    expected = [full_prefix_greedy(model, src, n) for src, n in zip(SOURCES, max_lens)]
+    preds = beam_search_decode(model, SOURCES, TGT_VOCAB, DEVICE, max_lens, beam_size=1)
+    assert preds == expected
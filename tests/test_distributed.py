@@ -0,0 +1,53 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+import torch.distributed as dist
+
+from src.seq2seq.data import build_dataloader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCAN = os.path.join(ROOT, 'data', 'scan', 'simple', 'train')
+
+
+def write_scan_head(tmp_path, lines):
+    for ext in ('src', 'tgt'):
+        with open(f'{SCAN}.{ext}', encoding='utf-8') as f:
+            head = [next(f) for _ in range(lines)]
+        (tmp_path / f'train.{ext}').write_text(''.join(head), encoding='utf-8')
+
+
+def train_losses(tmp_path, world_size, lines=300, epochs=2):
+    """Train the seq2seq model on the first SCAN lines and return its epoch losses."""
+    write_scan_head(tmp_path, lines)
+    cmd = [sys.executable, '-m', 'src.seq2seq.train',
+           '--src', str(tmp_path / 'train.src'), '--tgt', str(tmp_path / 'train.tgt'),
+           '--epochs', str(epochs), '--batch-size', '16', '--dropout', '0', '--seed', '3',
+           '--d-model', '32', '--nhead', '2', '--num-layers', '1', '--dim-ff', '64',
+           '--world-size', str(world_size), '--output', str(tmp_path / f'model{world_size}.pt')]
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    out = subprocess.run(cmd, cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+    return [float(x) for x in re.findall(r'^Epoch \d+: loss=([\d.]+)', out, re.MULTILINE)]
+
+
+@pytest.mark.skipif(not dist.is_available() or not dist.is_gloo_available(),
+                    reason='torch.distributed with gloo is not available')
+def test_two_processes_follow_single_process_losses(tmp_path):
+    single = train_losses(tmp_path, 1)
+    double = train_losses(tmp_path, 2)
+    assert len(single) == len(double) == 2
+    assert double == pytest.approx(single, abs=2e-3)
+
+
+def test_processes_split_examples_without_repeats(tmp_path):
+    write_scan_head(tmp_path, 301)
+    seen = []
+    for rank in range(2):
+        _, loader = build_dataloader(str(tmp_path / 'train.src'), str(tmp_path / 'train.tgt'),
+                                     8, shuffle=True, num_replicas=2, rank=rank, seed=3)
+        seen.append(list(loader.sampler))
+    # the odd example out is left out instead of repeated
+    assert len(seen[0]) == len(seen[1]) == 150
+    assert len(set(seen[0]) | set(seen[1])) == 300
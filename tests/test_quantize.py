@@ -0,0 +1,74 @@
+import pytest
+import torch
+
+from src.generate import load_model as load_lm
+from src.model import TransformerLM
+from src.quantize import quantize_dynamic, save_quantized
+from src.seq2seq.evaluate import batched_greedy_decode, load_model
+from src.seq2seq.model import Seq2SeqTransformer
+
+DEVICE = torch.device('cpu')
+SRC_VOCAB = {'<pad>': 0, '<unk>': 1, **{f's{i}': i for i in range(2, 12)}}
+TGT_VOCAB = {'<pad>': 0, '<unk>': 1, '<bos>': 2, '<eos>': 3, **{f't{i}': i for i in range(4, 14)}}
+SOURCES = [[5, 9, 3, 7], [4, 11], [8, 3, 3, 10, 6]]
+ARCH = dict(d_model=32, nhead=4, num_layers=1, dim_ff=64, dropout=0.0)
+
+
+def seq2seq_checkpoint(path):
+    torch.manual_seed(0)
+    model = Seq2SeqTransformer(len(SRC_VOCAB), len(TGT_VOCAB), ARCH['d_model'], ARCH['nhead'],
+                               ARCH['num_layers'], ARCH['dim_ff'], ARCH['dropout'])
+    torch.save({'model_state_dict': model.state_dict(),
+                'src_vocab': SRC_VOCAB, 'tgt_vocab': TGT_VOCAB}, path)
+
+
+def test_seq2seq_quantized_checkpoint_round_trip(tmp_path):
+    seq2seq_checkpoint(tmp_path / 'model.pt')
+    model, _, _ = load_model(tmp_path / 'model.pt', DEVICE, *ARCH.values(), quantize='int8')
+    save_quantized(model, torch.load(tmp_path / 'model.pt'), tmp_path / 'int8.pt')
+    assert torch.load(tmp_path / 'int8.pt', weights_only=False)['quantize'] == 'int8'
+
+    # the saved checkpoint is quantized on load without asking
+    loaded, _, _ = load_model(tmp_path / 'int8.pt', DEVICE, *ARCH.values())
+    assert loaded.quantize == 'int8'
+    assert isinstance(loaded.fc_out, torch.ao.nn.quantized.dynamic.Linear)
+    with torch.no_grad():
+        torch.testing.assert_close(loaded.fc_out.weight().dequantize(),
+                                   model.fc_out.weight().dequantize())
+        max_lens = [8] * len(SOURCES)
+        assert (batched_greedy_decode(loaded, SOURCES, TGT_VOCAB, DEVICE, max_lens)
+                == batched_greedy_decode(model, SOURCES, TGT_VOCAB, DEVICE, max_lens))
+
+
+def test_lm_quantized_checkpoint_round_trip(tmp_path):
+    vocab = {'<pad>': 0, '<unk>': 1, **{f'w{i}': i for i in range(2, 20)}}
+    torch.manual_seed(0)
+    model = TransformerLM(len(vocab), ARCH['d_model'], ARCH['nhead'], ARCH['num_layers'],
+                          ARCH['dim_ff'], ARCH['dropout'])
+    checkpoint = {'model_state_dict': model.state_dict(), 'vocab': vocab, 'seq_len': 16}
+    save_quantized(quantize_dynamic(model.eval()), checkpoint, tmp_path / 'int8.pt')
+
+    loaded, _, _ = load_lm(tmp_path / 'int8.pt', *ARCH.values(), DEVICE)
+    assert loaded.quantize == 'int8'
+    x = torch.randint(2, len(vocab), (2, 10))
+    with torch.no_grad():
+        torch.testing.assert_close(loaded(x, is_causal=True), model(x, is_causal=True))
+
+
+def test_save_quantized_rejects_float_model(tmp_path):
+    seq2seq_checkpoint(tmp_path / 'model.pt')
+    model, _, _ = load_model(tmp_path / 'model.pt', DEVICE, *ARCH.values())
+    with pytest.raises(ValueError):
+        save_quantized(model, torch.load(tmp_path / 'model.pt'), tmp_path / 'int8.pt')
+
+
+def test_quantized_models_load_on_cpu(tmp_path):
+    # int8 dynamic quantization has no CUDA kernels; the requested device is
+    # never touched, so this also runs on machines without a GPU
+    seq2seq_checkpoint(tmp_path / 'model.pt')
+    cuda = torch.device('cuda')
+    model, _, _ = load_model(tmp_path / 'model.pt', cuda, *ARCH.values(), quantize='int8')
+    assert next(model.parameters()).device == DEVICE
+    save_quantized(model, torch.load(tmp_path / 'model.pt'), tmp_path / 'int8.pt')
+    model, _, _ = load_model(tmp_path / 'int8.pt', cuda, *ARCH.values())
+    assert next(model.parameters()).device == DEVICE
@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+import torch
+
+from src.seq2seq.model import Seq2SeqTransformer
+from src.seq2seq.server import MicroBatcher, _handle
+
+SRC_VOCAB = {'<pad>': 0, '<unk>': 1, 'jump': 2, 'walk': 3, 'twice': 4}
+TGT_VOCAB = {'<pad>': 0, '<unk>': 1, '<bos>': 2, '<eos>': 3, 'JUMP': 4, 'WALK': 5}
+
+
+def make_batcher(**kwargs):
+    torch.manual_seed(0)
+    model = Seq2SeqTransformer(len(SRC_VOCAB), len(TGT_VOCAB), d_model=16, nhead=2,
+                               num_layers=1, dim_feedforward=32, dropout=0.0).eval()
+    return MicroBatcher(model, SRC_VOCAB, TGT_VOCAB, torch.device('cpu'), max_len=5, **kwargs)
+
+
+async def post(port, body):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = json.dumps(body).encode()
+    writer.write(b'POST /translate HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                 % len(data) + data)
+    await writer.drain()
+    response = (await reader.read()).decode()
+    writer.close()
+    head, _, payload = response.partition('\r\n\r\n')
+    return int(head.split()[1]), json.loads(payload)
+
+
+def serve_requests(batcher, bodies):
+    async def run():
+        worker = asyncio.create_task(batcher.run())
+        server = await asyncio.start_server(lambda r, w: _handle(batcher, r, w), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.gather(*(post(port, body) for body in bodies))
+        finally:
+            server.close()
+            worker.cancel()
+    return asyncio.run(run())
+
+
+def test_bad_requests_get_400():
+    batcher = make_batcher()
+    too_long = ' '.join(['jump'] * (batcher.max_src_len + 1))
+    responses = serve_requests(batcher, [{'src': 123}, {'src': too_long}, {'src': 'jump twice'}])
+    assert [status for status, _ in responses] == [400, 400, 200]
+
+
+def test_failed_request_does_not_fail_its_batch():
+    batcher = make_batcher(window_ms=200)
+    decode = batcher._decode
+
+    def failing_decode(src_batch):
+        # 'walk' stands for any input that breaks decoding
+        if any(SRC_VOCAB['walk'] in ids for ids in src_batch):
+            raise RuntimeError('decoding failed')
+        return decode(src_batch)
+
+    batcher._decode = failing_decode
+    responses = serve_requests(batcher, [{'src': 'jump'}, {'src': 'walk'}, {'src': 'jump twice'}])
+    assert list(batcher.batch_sizes) == [3]
+    assert [status for status, _ in responses] == [200, 500, 200]
+    assert 'decoding failed' in responses[1][1]['error']